@@ -11,6 +11,7 @@ from sqlalchemy.orm import sessionmaker
 config_path = Path(__file__).parent / 'config.ini'
 _engine = None
 _session = None
+_schema = 'wide'
 
 
 class DefaultEngineProxy:
@@ -56,6 +57,9 @@ Session = DefaultSessionProxy()
 config_fields = ['host', 'port', 'user', 'passwd', 'database', 'sql_type',
                  'charset']
 
+# the values of the optional config field schema, see normalised.py.
+schemas = ['wide', 'normalised']
+
 
 def interactive_configure_connection():
     print('Please enter the database connection information below.')
@@ -109,14 +113,36 @@ def read_config():
         return config
 
 
-def setup_database_connection():
+def use_schema(name):
+    """Chooses the schema of the financial statement entries, one of
+    schemas.  Processes started afterwards inherit the choice."""
+    global _schema
+    if name not in schemas:
+        raise ValueError('Unknown schema %r' % (name, ))
+    _schema = name
+    return
+
+
+def get_schema():
+    return _schema
+
+
+def setup_database_connection(local_infile=False):
+    """Creates the engine and Session from config.ini.  local_infile allows
+    LOAD DATA LOCAL INFILE on mysql, see bulk_load.py.  It is off by default
+    since it lets the server read files of the client."""
     global _engine, _session
 
     config = read_config()
+    use_schema(config['Global'].get('schema', 'wide'))
     connection_url = ("{sql_type}://{user}:{passwd}@{host}:{port}/"
                       "{database}?charset={charset}")
     connection_url = connection_url.format(**config['Global'])
-    _engine = create_engine(connection_url, encoding='utf-8')
+    connect_args = {}
+    if local_infile and config['Global']['sql_type'] == 'mysql':
+        connect_args['local_infile'] = 1
+    _engine = create_engine(connection_url, encoding='utf-8',
+                            connect_args=connect_args)
     _session = sessionmaker(bind=engine)
 
 
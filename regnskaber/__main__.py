@@ -7,22 +7,60 @@ from . import (interactive_ensure_config_exists, setup_database_connection,
 from . import fetch
 from . import make_feature_table as transform
 from . import make_feature_table_json
+from . import export_facts
+from . import reingest
+from . import regnskab_inserter
 
 
 class Commands:
     @staticmethod
-    def fetch(from_date, processes, **general_options):
+    def fetch(from_date, processes, download_engine, concurrency, batch_size,
+              flush_interval, native_load, slices, resume, checkpoint_days,
+              incremental, download_threads, cache_dir, offline, parser,
+              **general_options):
+        interactive_ensure_config_exists()
+        # setup engine and Session.
+        setup_database_connection(local_infile=native_load)
+        regnskab_inserter.use_parser(parser)
+        fetch.fetch_to_db(processes, from_date,
+                          download_engine=download_engine,
+                          concurrency=concurrency,
+                          batch_size=batch_size,
+                          flush_interval=flush_interval,
+                          native_load=native_load,
+                          slice_count=slices,
+                          resume=resume,
+                          checkpoint_days=checkpoint_days,
+                          incremental=incremental,
+                          download_threads=download_threads,
+                          cache_dir=cache_dir,
+                          offline=offline)
+
+    @staticmethod
+    def reingest(archive, processes, replace, parser, **general_options):
+        interactive_ensure_config_exists()
+        # setup engine and Session.
+        setup_database_connection()
+        regnskab_inserter.use_parser(parser)
+        reingest.reingest(archive, processes, replace=replace)
+
+    @staticmethod
+    def transform(table_definition_file, workers, numeric_engine,
+                  incremental, output, **general_options):
         interactive_ensure_config_exists()
         # setup engine and Session.
         setup_database_connection()
-        fetch.fetch_to_db(processes, from_date)
+        transform.main(table_definition_file, workers=workers,
+                       numeric_engine=numeric_engine,
+                       incremental=incremental, output=output)
 
     @staticmethod
-    def transform(table_definition_file, **general_options):
+    def export_facts(directory, file_rows, compression, **general_options):
         interactive_ensure_config_exists()
         # setup engine and Session.
         setup_database_connection()
-        transform.main(table_definition_file)
+        export_facts.export_facts(directory, file_rows=file_rows,
+                                  compression=compression)
 
     @staticmethod
     def transform_json(table_definition_file, **general_options):
@@ -55,10 +93,143 @@ parser_fetch.add_argument('-f', '--from-date',
 
 parser_fetch.add_argument('-p', '--processes',
                           dest='processes',
-                          help=('The number of parallel jobs to start.'),
+                          help=('The number of parallel jobs to start. With '
+                                '--engine staged, the number of parse '
+                                'processes.'),
                           type=int,
                           default=1)
 
+parser_fetch.add_argument('--engine',
+                          dest='download_engine',
+                          help=('How each process downloads financial '
+                                'statements. "async" keeps several downloads '
+                                'in flight per process. "staged" downloads, '
+                                'parses and inserts in separate stages.'),
+                          choices=['sync', 'async', 'staged'],
+                          default='sync')
+
+parser_fetch.add_argument('--download-threads',
+                          dest='download_threads',
+                          help=('The number of download threads when using '
+                                '--engine staged.'),
+                          type=int,
+                          default=16)
+
+parser_fetch.add_argument('--concurrency',
+                          dest='concurrency',
+                          help=('The number of downloads in flight per '
+                                'process when using --engine async.'),
+                          type=int,
+                          default=16)
+
+parser_fetch.add_argument('--batch-size',
+                          dest='batch_size',
+                          help=('Buffer the entries of many financial '
+                                'statements in each process and insert them '
+                                'in batches of this many entries. 0 inserts '
+                                'every financial statement by itself.'),
+                          type=int,
+                          default=0)
+
+parser_fetch.add_argument('--flush-interval',
+                          dest='flush_interval',
+                          help=('The maximum number of seconds a buffered '
+                                'financial statement waits before it is '
+                                'inserted when using --batch-size.'),
+                          type=float,
+                          default=30)
+
+parser_fetch.add_argument('--native-load',
+                          dest='native_load',
+                          help=('Load entries with COPY (postgresql) or LOAD '
+                                'DATA LOCAL INFILE (mysql) depending on '
+                                'sql_type in the configuration. Implies '
+                                '--batch-size 10000 unless it is given.'),
+                          action='store_true')
+
+parser_fetch.add_argument('--slices',
+                          dest='slices',
+                          help=('Split the elasticsearch scroll into this '
+                                'many slices, each scanned by its own '
+                                'producer process.'),
+                          type=int,
+                          default=1)
+
+parser_fetch.add_argument('--resume',
+                          dest='resume',
+                          help=('Start from the last checkpoint of a '
+                                'previous fetch instead of --from-date.'),
+                          action='store_true')
+
+parser_fetch.add_argument('--checkpoint-days',
+                          dest='checkpoint_days',
+                          help=('Store a checkpoint each time this many days '
+                                'of financial statements have been fetched.'),
+                          type=int,
+                          default=30)
+
+parser_fetch.add_argument('--incremental',
+                          dest='incremental',
+                          help=('Only fetch financial statements indexed '
+                                '(indlaesningsTidspunkt) since the last '
+                                'incremental fetch, replacing corrected ones.'),
+                          action='store_true')
+
+parser_fetch.add_argument('--cache-dir',
+                          dest='cache_dir',
+                          help=('Keep a compressed copy of every downloaded '
+                                'xbrl file in this directory, and read files '
+                                'from it instead of downloading them again.'),
+                          default=None)
+
+parser_fetch.add_argument('--offline',
+                          dest='offline',
+                          help=('Insert every financial statement in '
+                                '--cache-dir without contacting the Danish '
+                                'Business Authority.'),
+                          action='store_true')
+
+parser_fetch.add_argument('--parser',
+                          dest='parser',
+                          help=('How xbrl files are parsed. "stream" '
+                                'parses them incrementally with lxml and '
+                                'uses much less memory on large files, '
+                                'but its entries differ from xbrl_ai\'s, '
+                                'see the README.'),
+                          choices=['xbrl_ai', 'stream'],
+                          default='xbrl_ai')
+
+parser_reingest = subparsers.add_parser('reingest',
+                                        help=('insert financial statements '
+                                              'from a local archive of xbrl '
+                                              'files.'))
+parser_reingest.add_argument('archive', type=str,
+                             help=('A directory, tar or zip file with the '
+                                   'xbrl files and a manifest.csv, or a '
+                                   'directory made with fetch --cache-dir.'))
+
+parser_reingest.add_argument('-p', '--processes',
+                             dest='processes',
+                             help='The number of parallel jobs to start.',
+                             type=int,
+                             default=1)
+
+parser_reingest.add_argument('--replace',
+                             dest='replace',
+                             help=('Replace financial statements that are '
+                                   'already stored instead of skipping them.'),
+                             action='store_true')
+
+parser_reingest.add_argument('--parser',
+                             dest='parser',
+                             help=('How xbrl files are parsed. "stream" '
+                                   'parses them incrementally with lxml and '
+                                   'uses much less memory on large files, '
+                                   'but its entries differ from xbrl_ai\'s, '
+                                   'see the README.'),
+                             choices=['xbrl_ai', 'stream'],
+                             default='xbrl_ai')
+
 parser_transform = subparsers.add_parser('transform',
                                          help=('build useful tables from data '
                                                'fetched from erst.'))
@@ -67,12 +238,66 @@ parser_transform.add_argument('table_definition_file', type=str,
                                     'created. If the table name already '
                                     'exists, it is first deleted.'))
 
+parser_transform.add_argument('-w', '--workers',
+                              dest='workers',
+                              help=('The number of processes that compute '
+                                    'and insert rows in parallel, each over '
+                                    'its own range of financial statements.'),
+                              type=int,
+                              default=1)
+
+parser_transform.add_argument('--numeric-engine',
+                              dest='numeric_engine',
+                              help=('How generic_number columns are '
+                                    'computed. "numpy" computes them for '
+                                    'chunks of financial statements at once '
+                                    'with the same results.'),
+                              choices=['python', 'numpy'],
+                              default='python')
+
+parser_transform.add_argument('--incremental',
+                              dest='incremental',
+                              help=('Only add rows for financial statements '
+                                    'fetched since the last incremental '
+                                    'transform. Tables whose definition has '
+                                    'changed are rebuilt.'),
+                              action='store_true')
+
+parser_transform.add_argument('--output',
+                              dest='output',
+                              help=('Where the tables are written. By '
+                                    'default they are created in the '
+                                    'database. parquet:DIRECTORY writes '
+                                    'them as Parquet files in DIRECTORY, '
+                                    'joined with the Header table and '
+                                    'partitioned by the year of balancedato. '
+                                    'Requires pyarrow.'),
+                              default=None)
+
 parser_transform_json = subparsers.add_parser('transform_json',
                                          help=('build useful json table from data '
                                                'fetched from erst.'))
 parser_transform_json.add_argument('table_definition_file', type=str,
                                    help=('A file that specifies the table to be created. If the table name already exists, it is first deleted.'))
 
+parser_export_facts = subparsers.add_parser(
+    'export_facts',
+    help=('export financial_statement_entry to Parquet files, adding the '
+          'entries inserted since the last export.')
+)
+parser_export_facts.add_argument('directory', type=str,
+                                 help='The directory of the export.')
+parser_export_facts.add_argument('--file-rows',
+                                 dest='file_rows',
+                                 help='The number of entries per file.',
+                                 type=int,
+                                 default=5000000)
+parser_export_facts.add_argument('--compression',
+                                 dest='compression',
+                                 help='The Parquet compression codec.',
+                                 choices=['zstd', 'snappy', 'gzip', 'none'],
+                                 default='zstd')
+
 parser_reconfigure = subparsers.add_parser('reconfigure',
                                            help='Reconfigure database info.')
 
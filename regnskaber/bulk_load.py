@@ -0,0 +1,101 @@
+""" Native bulk loading of financial_statement_entry rows.
+
+Instead of INSERT statements the rows are streamed through the bulk load path
+of the database, COPY FROM STDIN on postgresql and LOAD DATA LOCAL INFILE on
+mysql.  Both read the same tab separated text format.  The rows go to
+financial_statement_entry, or to the table given, e.g. normalised_entry.
+"""
+import datetime
+import io
+import tempfile
+
+from sqlalchemy import text
+
+from .models import FinancialStatementEntry
+
+
+def entry_columns(table):
+    """Returns the columns of table besides id and financial_statement_id."""
+    return [column.name for column in table.columns
+            if column.name not in ('id', 'financial_statement_id')]
+
+
+def encode_value(value):
+    """Encodes value as a field of the text format read by COPY and LOAD
+    DATA."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat(sep=' ')
+    value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def write_rows(fp, rows, columns):
+    for row in rows:
+        fp.write('\t'.join(encode_value(row[c]) for c in columns))
+        fp.write('\n')
+
+
+def postgresql_copy(connection, rows,
+                    table=FinancialStatementEntry.__table__):
+    # The id column has no server side default, so the ids are drawn from the
+    # sequence in one round-trip before copying.
+    sequence = table.c.id.default.name
+    ids = connection.execute(
+        text("SELECT nextval('%s') FROM generate_series(1, :n)" % sequence),
+        n=len(rows)
+    ).fetchall()
+    rows = [dict(row, id=id_) for row, (id_,) in zip(rows, ids)]
+    columns = ['id', 'financial_statement_id'] + entry_columns(table)
+
+    buffer = io.StringIO()
+    write_rows(buffer, rows, columns)
+    buffer.seek(0)
+    statement = 'COPY %s (%s) FROM STDIN' % (
+        table.name,
+        ', '.join('"%s"' % c for c in columns)
+    )
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+    return
+
+
+def mysql_load_data(connection, rows,
+                    table=FinancialStatementEntry.__table__):
+    # mysqlclient can only LOAD DATA LOCAL from a file, so the buffer is a
+    # temporary file.  Requires local_infile to be enabled on the server.
+    columns = ['financial_statement_id'] + entry_columns(table)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8',
+                                     suffix='.tsv') as fp:
+        write_rows(fp, rows, columns)
+        fp.flush()
+        statement = ("LOAD DATA LOCAL INFILE :path INTO TABLE %s "
+                     "CHARACTER SET utf8mb4 "
+                     "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                     "LINES TERMINATED BY '\\n' (%s)") % (
+                         table.name,
+                         ', '.join('`%s`' % c for c in columns)
+                     )
+        connection.execute(text(statement), path=fp.name)
+    return
+
+
+loaders = {
+    'postgresql': postgresql_copy,
+    'mysql': mysql_load_data,
+}
+
+
+def get_entry_loader(sql_type):
+    """Returns the native loader for sql_type (as in config.ini)."""
+    try:
+        return loaders[sql_type]
+    except KeyError:
+        raise ValueError('No native bulk loader for sql_type %s' % sql_type)
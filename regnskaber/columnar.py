@@ -0,0 +1,119 @@
+""" Vectorised computation of generic_number columns.
+
+make_feature_table.generic_number picks the most precise entry of a fieldName
+by sorting the entries with a python key function, one column of one
+financial statement at a time.  number_columns does the same for every
+generic_number column of a whole chunk of financial statements at once: the
+entries are loaded into numpy arrays and sorted together with lexsort, and
+the last entry of each (statement, fieldName) group is the most precise.
+
+Cells where the python sort would compare None with a value, and therefore
+raise, and columns with dimensions are computed by generic_number itself, so
+the results are always the same.
+"""
+import numpy as np
+
+
+def parse_decimals(decimals):
+    """Returns (is_dec_inf, dec) like the key of get_most_precise, or None
+    if decimals cannot be parsed."""
+    if decimals is None:
+        return False, -1000.0
+    if decimals.lower() == 'inf':
+        return True, -1000.0
+    if len(decimals) == 0:
+        return False, -1000.0
+    try:
+        return False, float(decimals)
+    except ValueError:
+        return None
+
+
+def number_columns(fs_dicts, columns, generic_number):
+    """Computes generic_number columns for a chunk of financial statements.
+
+    fs_dicts is a list of dicts from fieldName to entries, one per row.
+    columns is a list of (column name, fieldName, dimensions) triples.
+    generic_number is make_feature_table.generic_number, which is used for
+    the cells that cannot be vectorised and for the values of absent
+    fieldNames.
+
+    Returns a dict from column name to a list with a value per row.
+    """
+    result = {}
+    field_codes = {}
+    for name, fieldName, dimensions in columns:
+        if dimensions is None:
+            field_codes.setdefault(fieldName, len(field_codes))
+        else:
+            result[name] = [generic_number(fs_dict, fieldName,
+                                           dimensions=dimensions)
+                            for fs_dict in fs_dicts]
+    if not field_codes:
+        return result
+
+    rows, codes, starts, ends, decs, infs, values = [], [], [], [], [], [], []
+    bad = set()  # groups with decimals that cannot be parsed.
+    fallback = set()  # groups that must be computed by generic_number.
+    field_count = len(field_codes)
+    for row, fs_dict in enumerate(fs_dicts):
+        for fieldName, code in field_codes.items():
+            for t in fs_dict.get(fieldName, ()):
+                group = row * field_count + code
+                parsed = parse_decimals(t.decimals)
+                if parsed is None:
+                    bad.add(group)
+                    continue
+                if t.fieldValue is None or parsed[1] != parsed[1]:
+                    # None cannot be compared, and nan does not sort.
+                    fallback.add(group)
+                    continue
+                rows.append(row)
+                codes.append(code)
+                starts.append(t.startDate)
+                ends.append(t.endDate)
+                infs.append(parsed[0])
+                decs.append(parsed[1])
+                values.append(t.fieldValue)
+
+    winners = {}
+    if rows:
+        groups = (np.array(rows, dtype=np.int64) * field_count +
+                  np.array(codes, dtype=np.int64))
+        starts = np.array(starts, dtype='datetime64[us]')
+        ends = np.array(ends, dtype='datetime64[us]')
+        # a group where some but not all dates are None makes the python
+        # sort raise.
+        sizes = np.bincount(groups)
+        for dates in (starts, ends):
+            nones = np.bincount(groups, weights=np.isnat(dates))
+            mixed = np.nonzero((nones > 0) & (nones < sizes))[0]
+            fallback.update(mixed.tolist())
+        order = np.lexsort((np.array(values), np.array(decs),
+                            np.array(infs), ends, starts, groups))
+        sorted_groups = groups[order]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = sorted_groups[1:] != sorted_groups[:-1]
+        for group, index in zip(sorted_groups[last].tolist(),
+                                order[last].tolist()):
+            winners[group] = values[index]
+
+    for name, fieldName, dimensions in columns:
+        if dimensions is not None:
+            continue
+        code = field_codes[fieldName]
+        absent = generic_number({}, fieldName)
+        column = []
+        for row, fs_dict in enumerate(fs_dicts):
+            group = row * field_count + code
+            if group in fallback:
+                column.append(generic_number(fs_dict, fieldName))
+            elif group in bad or group not in winners:
+                column.append(absent)
+            else:
+                try:
+                    column.append(float(winners[group]))
+                except ValueError:
+                    column.append(absent)
+        result[name] = column
+    return result
@@ -0,0 +1,197 @@
+""" Exports financial_statement_entry to Parquet files.
+
+The entries are read in order of id with keyset pagination and written to
+
+    <directory>/facts-<first id>-<last id>.parquet
+
+starting a new file once a file holds file_rows entries.  fieldName,
+unitIdXbrl and dimensions are dictionary encoded.  A file is written under a
+temporary name and renamed when complete, so the largest id in the files is
+where the next export starts: an interrupted export resumes, and a later
+export only adds the entries inserted since.
+
+Entry ids are not committed in order while fetch is inserting, so an entry
+may become visible after an export has passed its id.  The export must
+therefore not run during a fetch.  As a safety margin every export also
+reads the last margin ids before where it starts again, and writes the ones
+that are not in the files yet.  Entries deleted from the database after they
+were exported (e.g. of financial statements that fetch --incremental
+replaced) stay in the files.  In the normalised schema (see normalised.py)
+the files are the same, with the values looked up once per chunk.
+
+Requires pyarrow, e.g. pip install regnskaber[parquet].
+"""
+import glob
+import os
+import re
+
+from sqlalchemy import select
+
+from .normalised import entry_columns, entry_table, entry_values
+from .parquet_sink import check_pyarrow, pyarrow
+from .shared import entry_fields
+from . import engine
+
+file_pattern = re.compile(r'^facts-(\d+)-(\d+)\.parquet$')
+
+dictionary_fields = ['fieldName', 'unitIdXbrl', 'dimensions']
+
+
+def fact_schema():
+    string_dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    types = {
+        'id': pyarrow.int64(),
+        'financial_statement_id': pyarrow.int64(),
+        'fieldName': string_dictionary,
+        'fieldValue': pyarrow.string(),
+        'decimals': pyarrow.string(),
+        'cvrnummer': pyarrow.int64(),
+        'startDate': pyarrow.timestamp('us'),
+        'endDate': pyarrow.timestamp('us'),
+        'dimensions': string_dictionary,
+        'unitIdXbrl': string_dictionary,
+        'koncern': pyarrow.bool_(),
+    }
+    return pyarrow.schema([pyarrow.field(name, types[name])
+                           for name in entry_fields])
+
+
+def file_name(first_id, last_id):
+    return 'facts-%012d-%012d.parquet' % (first_id, last_id)
+
+
+def last_exported_id(directory):
+    """Returns the largest entry id in the export in directory, or 0 if
+    nothing has been exported."""
+    last_id = 0
+    for name in os.listdir(directory):
+        match = file_pattern.match(name)
+        if match:
+            last_id = max(last_id, int(match.group(2)))
+    return last_id
+
+
+def exported_ids(directory, after_id):
+    """Returns the set of entry ids > after_id in the export in
+    directory."""
+    ids = set()
+    for name in os.listdir(directory):
+        match = file_pattern.match(name)
+        if match and int(match.group(2)) > after_id:
+            table = pyarrow.parquet.read_table(os.path.join(directory, name),
+                                               columns=['id'])
+            ids.update(id_ for id_ in table.column('id').to_pylist()
+                       if id_ > after_id)
+    return ids
+
+
+def remove_partial_files(directory):
+    for path in glob.glob(os.path.join(directory, '*.parquet.tmp')):
+        os.remove(path)
+
+
+def iter_fact_chunks(after_id=0, chunk_size=50000, skip_ids=()):
+    """Yields the entries with id > after_id and id not in skip_ids in order
+    of id, in lists of at most chunk_size tuples of the values of
+    entry_fields."""
+    table = entry_table()
+    query = select(entry_columns(entry_fields)).order_by(
+        table.c.id
+    ).limit(chunk_size)
+    with engine.connect() as connection:
+        while True:
+            rows = connection.execute(
+                query.where(table.c.id > after_id)
+            ).fetchall()
+            new_rows = [row for row in rows if row['id'] not in skip_ids]
+            if new_rows:
+                yield entry_values(new_rows, entry_fields)
+            if len(rows) < chunk_size:
+                break
+            after_id = rows[-1]['id']
+    return
+
+
+def record_batch(rows, schema):
+    arrays = []
+    for i, field in enumerate(schema):
+        values = [row[i] for row in rows]
+        if field.name in dictionary_fields:
+            array = pyarrow.array(values, type=pyarrow.string())
+            array = array.dictionary_encode()
+        elif field.name == 'koncern':
+            array = pyarrow.array(
+                [None if value is None else bool(value) for value in values],
+                type=field.type
+            )
+        else:
+            array = pyarrow.array(values, type=field.type)
+        arrays.append(array)
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class FactFile(object):
+    """A Parquet file of facts that is being written."""
+
+    def __init__(self, directory, schema, compression):
+        self.directory = directory
+        self.path = os.path.join(directory, 'facts.parquet.tmp')
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.path, schema, compression=compression,
+            use_dictionary=dictionary_fields
+        )
+        self.first_id = None
+        self.last_id = None
+        self.rows = 0
+
+    def write(self, batch, first_id, last_id):
+        self.writer.write_batch(batch)
+        if self.first_id is None:
+            self.first_id = first_id
+        self.last_id = last_id
+        self.rows += batch.num_rows
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.path, os.path.join(
+            self.directory, file_name(self.first_id, self.last_id)
+        ))
+
+
+def export_facts(directory, file_rows=5000000, chunk_size=50000,
+                 compression='zstd', margin=100000):
+    """Exports the entries of financial_statement_entry that are not in the
+    export in directory yet.  Returns the number of entries exported.
+
+    The margin ids before the largest exported id are read again and the
+    entries among them that are not in the export are added, see the module
+    docstring.
+    """
+    check_pyarrow()
+    os.makedirs(directory, exist_ok=True)
+    remove_partial_files(directory)
+    after_id = max(0, last_exported_id(directory) - margin)
+    skip_ids = exported_ids(directory, after_id)
+    schema = fact_schema()
+    id_index = entry_fields.index('id')
+    count = 0
+    current = None
+    print('Exporting entries with id > %s to %s' % (after_id, directory))
+    ERASE = '\r\x1B[K'
+    progress_template = "Exported %s entries, last id %s"
+    for rows in iter_fact_chunks(after_id, chunk_size, skip_ids):
+        if current is None:
+            current = FactFile(directory, schema, compression)
+        first_id, last_id = rows[0][id_index], rows[-1][id_index]
+        current.write(record_batch(rows, schema), first_id, last_id)
+        count += len(rows)
+        print(ERASE, end='', flush=True)
+        print(progress_template % (count, last_id), end='', flush=True)
+        if current.rows >= file_rows:
+            current.close()
+            current = None
+    if current is not None:
+        current.close()
+    print(ERASE, end='', flush=True)
+    print('Exported %s entries' % count)
+    return count
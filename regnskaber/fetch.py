@@ -1,25 +1,35 @@
+import asyncio
 import csv
 import functools
+import hashlib
 import os
 import sys
 import tempfile
-import time
+import threading
 
-from datetime import datetime
-from multiprocessing import Process, Lock
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import Array, Pool, Process
+from queue import Empty, Queue
 
 import requests
 
+from requests.adapters import HTTPAdapter
+
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
 
-from .ioqueue import IOQueueManager
+from .ioqueue import IOQueue
 
 from .unitrefs import UnitHandler
-from .regnskab_inserter import drive_regnskab
+from .regnskab_inserter import BulkInserter, drive_regnskab, parse_regnskab
+from .bulk_load import get_entry_loader
+from .xbrl_cache import XbrlCache
 
 from . import Session, engine, parse_date
-from .models import FinancialStatement, Base
+from .models import FinancialStatement, FetchCheckpoint, Base
 
 ERASE = '\r\x1B[K'
 ENCODING = 'UTF-8'
@@ -56,6 +66,17 @@ class InputRegnskabError(Exception):
         return msg
 
 
+def make_http_session(pool_size=10):
+    """Returns a requests.Session that keeps up to pool_size connections
+    alive, so consecutive downloads reuse their TCP connections.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class InputRegnskab(object):
     """Responsible for providing financial_statement data based on the xbrl_file
     and its possible extension.
@@ -63,13 +84,23 @@ class InputRegnskab(object):
 
     def __init__(self, cvrnummer, offentliggoerelsesTidspunkt,
                  xbrl_file_url, xbrl_extension_url, erst_id,
-                 indlaesningsTidspunkt):
+                 indlaesningsTidspunkt, http_session=None, cache=None):
         self.cvrnummer = cvrnummer
         self.erst_id = erst_id
         self.offentliggoerelsesTidspunkt = offentliggoerelsesTidspunkt
         self.indlaesningsTidspunkt = indlaesningsTidspunkt
         self.xbrl_file_url = xbrl_file_url
-        self.xbrl_file_contents = self._download_file(xbrl_file_url)
+        self.xbrl_extension_url = xbrl_extension_url
+        self.http_session = http_session
+        self.cache = cache
+        self.xbrl_file_bytes = self._load_file(xbrl_file_url)
+
+    @property
+    def xbrl_file_contents(self):
+        """The xbrl file decoded as utf-8, for parsers that need a str.  The
+        streaming parser reads xbrl_file_bytes and honours the encoding in the
+        xml declaration instead."""
+        return self.xbrl_file_bytes.decode('utf-8')
 
     def __enter__(self):
         return self
@@ -77,25 +108,40 @@ class InputRegnskab(object):
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
+    def _load_file(self, xbrl_file_url):
+        """Reads the xbrl file from the cache if possible, and downloads
+        (and caches) it otherwise.  Returns the raw bytes of the file."""
+        if self.cache is not None:
+            contents = self.cache.get(xbrl_file_url)
+            if contents is not None:
+                return contents
+            if self.cache.offline:
+                error_msg = 'Error: xbrl file is not cached: %s' % (
+                    xbrl_file_url
+                )
+                raise InputRegnskabError(self.erst_id, self.cvrnummer,
+                                         self.offentliggoerelsesTidspunkt,
+                                         error_msg)
+        contents = self._download_file(xbrl_file_url)
+        if self.cache is not None:
+            self.cache.put(self, contents)
+        return contents
+
     def _download_file(self, xbrl_file_url):
-        response = requests.get(xbrl_file_url)
+        if self.http_session is None:
+            response = requests.get(xbrl_file_url)
+        else:
+            response = self.http_session.get(xbrl_file_url)
         if response.status_code != 200:
             error_msg = ('Status code when attempting to download file '
                          'was %s' % response.status_code)
             raise InputRegnskabError(self.erst_id, self.cvrnummer,
                                      self.offentliggoerelsesTidspunkt,
                                      error_msg)
-        try:
-            self.xbrl_charset = response.encoding
-            return response.text.encode(response.encoding).decode('utf-8')
-        except OSError as exc:
-            error_msg = 'Error: could not decode xbrl file: %s\n' % (
-                xbrl_file_url
-            )
-            raise InputRegnskabError(self.erst_id, self.cvrnummer,
-                                     self.offentliggoerelsesTidspunkt,
-                                     error_msg)
-        return None
+        # the charset from the headers, if any.  response.text is not used,
+        # as it would detect the charset and decode the whole file.
+        self.xbrl_charset = response.encoding
+        return response.content
 
 
 def query_by_erst_id(erst_id):
@@ -119,27 +165,40 @@ def query_by_erst_id(erst_id):
 # insert csv into database.
 
 def process(cvrnummer, offentliggoerelsesTidspunkt, xbrl_file, xbrl_extension,
-            erst_id, indlaesningsTidspunkt, unit_handler):
-    if erst_id_present(erst_id):
+            erst_id, indlaesningsTidspunkt, unit_handler, http_session=None,
+            inserter=None, incremental=False, cache=None):
+    mode = insert_mode(erst_id, indlaesningsTidspunkt, incremental)
+    if mode is None:
         return
     try:
         with InputRegnskab(cvrnummer, offentliggoerelsesTidspunkt,
                            xbrl_file, xbrl_extension, erst_id,
-                           indlaesningsTidspunkt) as regnskab:
-            drive_regnskab(regnskab)
+                           indlaesningsTidspunkt,
+                           http_session=http_session,
+                           cache=cache) as regnskab:
+            drive_regnskab(regnskab, inserter=inserter,
+                           replace=(mode == 'replace'))
     except InputRegnskabError as e:
-        with open('erst_data_errors.txt', 'a') as f:
-            print(e, file=f, flush=True)
+        log_input_regnskab_error(e)
     except Exception as e:
-        import traceback
-        etype, exc, tb = sys.exc_info()
-        msg = '[erst_id = %s] Caught Exception.\n' % erst_id
-        msg += ''.join(traceback.format_tb(tb))
-        print(msg, file=sys.stderr, flush=True)
+        log_exception(erst_id)
     return
 
 
-def debug_by_erst_id(erst_id):
+def log_input_regnskab_error(error):
+    with open('erst_data_errors.txt', 'a') as f:
+        print(error, file=f, flush=True)
+
+
+def log_exception(erst_id):
+    import traceback
+    etype, exc, tb = sys.exc_info()
+    msg = '[erst_id = %s] Caught Exception.\n' % erst_id
+    msg += ''.join(traceback.format_tb(tb))
+    print(msg, file=sys.stderr, flush=True)
+
+
+def debug_by_erst_id(erst_id, cache=None):
     # datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
     hits, reponse = query_by_erst_id(erst_id)
     hit = hits[0]
@@ -169,7 +228,7 @@ def debug_by_erst_id(erst_id):
     if xbrl_file_url is not None:
         regnskab = InputRegnskab(cvrnummer, offentliggoerelsesTidspunkt,
                                  xbrl_file_url, xbrl_extension_url, erst_id,
-                                 indlaesningsTidspunkt)
+                                 indlaesningsTidspunkt, cache=cache)
         drive_regnskab(regnskab)
     return
 
@@ -185,6 +244,90 @@ def erst_id_present(erst_id):
         session.close()
 
 
+def stored_indlaesningsTidspunkt(erst_id):
+    """Returns (True, indlaesningsTidspunkt) of the stored financial statement
+    with erst_id, or (False, None) if there is none."""
+    session = Session()
+    try:
+        found = session.query(FinancialStatement.indlaesningsTidspunkt).filter(
+            FinancialStatement.erst_id == erst_id
+        ).first()
+        if found is None:
+            return False, None
+        return True, found[0]
+    finally:
+        session.close()
+
+
+def insert_mode(erst_id, indlaesningsTidspunkt, incremental=False):
+    """Decides what to do with the financial statement erst_id.
+
+    Returns None if it is already stored, 'insert' if it is new and 'replace'
+    if incremental is true and the stored version was indexed before
+    indlaesningsTidspunkt, i.e. it has been corrected since.
+    """
+    if not incremental:
+        return None if erst_id_present(erst_id) else 'insert'
+    found, stored = stored_indlaesningsTidspunkt(erst_id)
+    if not found:
+        return 'insert'
+    if stored is None or stored < indlaesningsTidspunkt:
+        return 'replace'
+    return None
+
+
+def erst_id_digest(erst_id):
+    digest = hashlib.blake2b(erst_id.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+class KnownErstIds(object):
+    """A compact set of the erst_ids already in financial_statement.
+
+    Every erst_id is stored as a 64 bit digest in a sorted array, so two
+    million ids take 16 MB and a lookup is a binary search.  The chance that
+    a new erst_id collides with one of n stored digests is about n / 2**64.
+    """
+
+    def __init__(self, erst_ids=()):
+        digests = sorted(set(erst_id_digest(e) for e in erst_ids))
+        self._digests = array('Q', digests)
+
+    @classmethod
+    def from_db(cls, buffer_size=100000):
+        """Loads every erst_id from financial_statement in chunks of
+        buffer_size rows.
+        """
+        digests = array('Q')
+        session = Session()
+        try:
+            last_id = 0
+            while True:
+                rows = session.query(
+                    FinancialStatement.id, FinancialStatement.erst_id
+                ).filter(
+                    FinancialStatement.id > last_id
+                ).order_by(FinancialStatement.id).limit(buffer_size).all()
+                if not rows:
+                    break
+                digests.extend(erst_id_digest(erst_id)
+                               for _, erst_id in rows if erst_id is not None)
+                last_id = rows[-1][0]
+        finally:
+            session.close()
+        known = cls()
+        known._digests = array('Q', sorted(set(digests)))
+        return known
+
+    def __contains__(self, erst_id):
+        digest = erst_id_digest(erst_id)
+        idx = bisect_left(self._digests, digest)
+        return idx < len(self._digests) and self._digests[idx] == digest
+
+    def __len__(self):
+        return len(self._digests)
+
+
 def error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt):
     msg = ("[erst_id = %s] [offentliggoerelsesTidspunkt: %s] "
            "Error: CVR-nummer returned by elasticsearch was None") % (
@@ -194,45 +337,463 @@ def error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt):
     return
 
 
-def consumer_insert(queue, unit_handler=None, queue_lock=None):
+def next_message(queue, timeout=1):
+    """Pops the next message from queue, waiting up to timeout seconds for
+    one to arrive.  Returns None if the queue stayed empty.
+    """
+    try:
+        msg = queue.get(timeout=timeout)
+    except Empty:
+        return None
+    popped, pushed = queue.get_statistics()
+    print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
+          end='', flush=True, file=sys.stderr)
+    return msg
+
+
+def parse_message(msg):
+    """Decodes a message put on the queue by producer_scan into the arguments
+    of process (without the unit_handler).
+    """
+    cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url = msg[:3]
+    xbrl_extension_url, erst_id, indlaesningsTidspunkt = msg[3:]
+    offentliggoerelsesTidspunkt = parse_date(offentliggoerelsesTidspunkt)
+    indlaesningsTidspunkt = parse_date(indlaesningsTidspunkt)
+    return (cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url,
+            xbrl_extension_url, erst_id, indlaesningsTidspunkt)
+
+
+def make_inserter(batch_size=0, flush_interval=30, native_load=False):
+    """Returns a BulkInserter, or None to insert each financial statement in
+    its own transaction when batch_size is 0.
+
+    With native_load the entries are loaded with the bulk load path of the
+    database (see bulk_load.py), which always batches.
+    """
+    loader = None
+    if native_load:
+        loader = get_entry_loader(engine.dialect.name)
+        batch_size = batch_size or 10000
+    if not batch_size:
+        return None
+    return BulkInserter(batch_size=batch_size, flush_interval=flush_interval,
+                        loader=loader)
+
+
+class WindowProgress(object):
+    """The last window of fetch_to_db that each consumer has committed,
+    shared between processes.
+
+    fetch_to_db puts ('CHECKPOINT', window) on the queue after the messages of
+    each window.  A consumer that gets a marker records the window once every
+    message it got before the marker is committed.  Since the queue is first
+    in first out, a window is committed by all consumers when each of them has
+    recorded it or a later one, whichever consumer got which marker.
+    """
+
+    finished = 2**62
+
+    def __init__(self, consumer_count):
+        self._windows = Array('q', [-1] * consumer_count)
+
+    def committed(self, consumer_id, window):
+        with self._windows.get_lock():
+            if window > self._windows[consumer_id]:
+                self._windows[consumer_id] = window
+
+    def finish(self, consumer_id):
+        """Records that consumer_id has committed everything it got."""
+        self.committed(consumer_id, self.finished)
+
+    def lowest(self):
+        with self._windows.get_lock():
+            return min(self._windows)
+
+
+def checkpoint_window(msg):
+    """Returns the window of a checkpoint marker, or None if msg is not
+    one."""
+    if isinstance(msg, tuple) and len(msg) == 2 and msg[0] == 'CHECKPOINT':
+        return msg[1]
+    return None
+
+
+def consumer_insert(queue, unit_handler=None, batch_size=0, flush_interval=30,
+                    native_load=False, progress=None, consumer_id=0,
+                    incremental=False, cache=None):
     engine.dispose()  # for multiprocessing.
-    if unit_handler is None:
+    if unit_handler is None and (cache is None or not cache.offline):
         unit_handler = UnitHandler()
+    http_session = make_http_session()
+    inserter = make_inserter(batch_size, flush_interval, native_load)
     while True:
-        do_sleep = False
-        try:
-            queue_lock.acquire()
-            if queue.size() == 0:
-                do_sleep = True
-                continue
-            msg = queue.get()
-            popped, pushed = queue.get_statistics()
-            print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
-                  end='', flush=True, file=sys.stderr)
-        finally:
-            queue_lock.release()
-            if do_sleep:
-                time.sleep(2)
+        msg = next_message(queue)
+        if msg is None:
+            if inserter is not None:
+                inserter.flush_if_due()
+            continue
 
         if isinstance(msg, str) and msg == 'DONE':
+            if inserter is not None:
+                inserter.flush()
+            if progress is not None:
+                progress.finish(consumer_id)
             break
-        cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url = msg[:3]
-        xbrl_extension_url, erst_id, indlaesningsTidspunkt = msg[3:]
-        offentliggoerelsesTidspunkt = parse_date(offentliggoerelsesTidspunkt)
-        indlaesningsTidspunkt = parse_date(indlaesningsTidspunkt)
+        window = checkpoint_window(msg)
+        if window is not None:
+            # everything before the marker is processed; commit it.
+            if inserter is not None:
+                inserter.flush()
+            progress.committed(consumer_id, window)
+            continue
+        args = parse_message(msg)
+        cvrnummer, offentliggoerelsesTidspunkt = args[:2]
+        erst_id = args[4]
         try:
             if cvrnummer is None:
                 error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt)
                 continue
-            process(cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url,
-                    xbrl_extension_url, erst_id, indlaesningsTidspunkt,
-                    unit_handler)
-        except Exception as e:
+            process(*args, unit_handler, http_session=http_session,
+                    inserter=inserter, incremental=incremental, cache=cache)
+        except Exception:
             # already logged elsewhere.
             pass
     return
 
 
+async def process_async(args, http_session, downloader, inserter,
+                        bulk_inserter=None, incremental=False, cache=None):
+    """Asynchronous counterpart of process.
+
+    The download runs on the downloader executor so that many downloads can
+    be in flight at once, while the database work is serialized on the
+    inserter executor.
+    """
+    loop = asyncio.get_event_loop()
+    cvrnummer, offentliggoerelsesTidspunkt = args[:2]
+    erst_id, indlaesningsTidspunkt = args[4:]
+    if cvrnummer is None:
+        error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt)
+        return
+    try:
+        mode = await loop.run_in_executor(inserter, insert_mode, erst_id,
+                                          indlaesningsTidspunkt, incremental)
+        if mode is None:
+            return
+        download = functools.partial(InputRegnskab, *args,
+                                     http_session=http_session, cache=cache)
+        regnskab = await loop.run_in_executor(downloader, download)
+        insert = functools.partial(drive_regnskab, regnskab,
+                                   inserter=bulk_inserter,
+                                   replace=(mode == 'replace'))
+        await loop.run_in_executor(inserter, insert)
+    except InputRegnskabError as e:
+        log_input_regnskab_error(e)
+    except Exception:
+        log_exception(erst_id)
+    return
+
+
+async def consume_async(queue, concurrency, bulk_inserter=None,
+                        progress=None, consumer_id=0, incremental=False,
+                        cache=None):
+    loop = asyncio.get_event_loop()
+    http_session = make_http_session(concurrency)
+    in_flight = asyncio.Semaphore(concurrency)
+    pending = set()
+    markers = set()
+
+    def task_done(task):
+        pending.discard(task)
+        in_flight.release()
+
+    async def commit_window(tasks, window):
+        # records window once the tasks started before its marker are done,
+        # without holding up the tasks started after it.
+        if tasks:
+            await asyncio.wait(tasks)
+        if bulk_inserter is not None:
+            await loop.run_in_executor(inserter, bulk_inserter.flush)
+        progress.committed(consumer_id, window)
+
+    with ThreadPoolExecutor(concurrency) as downloader, \
+            ThreadPoolExecutor(1) as inserter:
+        while True:
+            await in_flight.acquire()
+            msg = await loop.run_in_executor(None, next_message, queue)
+            if msg is None:
+                in_flight.release()
+                if bulk_inserter is not None:
+                    await loop.run_in_executor(inserter,
+                                               bulk_inserter.flush_if_due)
+                continue
+            if isinstance(msg, str) and msg == 'DONE':
+                in_flight.release()
+                break
+            window = checkpoint_window(msg)
+            if window is not None:
+                in_flight.release()
+                marker = loop.create_task(commit_window(set(pending), window))
+                markers.add(marker)
+                marker.add_done_callback(markers.discard)
+                continue
+            task = loop.create_task(
+                process_async(parse_message(msg), http_session, downloader,
+                              inserter, bulk_inserter, incremental, cache)
+            )
+            pending.add(task)
+            task.add_done_callback(task_done)
+        if pending or markers:
+            await asyncio.wait(pending | markers)
+        if bulk_inserter is not None:
+            await loop.run_in_executor(inserter, bulk_inserter.flush)
+        if progress is not None:
+            progress.finish(consumer_id)
+    return
+
+
+def consumer_insert_async(queue, unit_handler=None, concurrency=16,
+                          batch_size=0, flush_interval=30, native_load=False,
+                          progress=None, consumer_id=0, incremental=False,
+                          cache=None):
+    """Like consumer_insert, but keeps up to concurrency downloads in flight
+    over a shared pool of keep-alive connections.
+    """
+    engine.dispose()  # for multiprocessing.
+    bulk_inserter = make_inserter(batch_size, flush_interval, native_load)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(consume_async(queue, concurrency,
+                                              bulk_inserter, progress,
+                                              consumer_id, incremental,
+                                              cache))
+    finally:
+        loop.close()
+    return
+
+
+class StagedPipeline(object):
+    """Processes financial statements in three stages with their own
+    concurrency: download_threads threads download, a pool of parse_processes
+    processes parses, and one writer thread inserts in batches.
+
+    The stages are connected by bounded queues, so a slow stage holds back
+    the ones before it instead of buffering without limit.
+
+    Every financial statement gets a sequence number and stays in _in_flight
+    until it has been committed by a flush of the inserter (or has failed),
+    so a checkpoint marker is recorded, see WindowProgress, as soon as every
+    statement received before it has left _in_flight.
+    """
+
+    def __init__(self, download_threads=16, parse_processes=1,
+                 inserter=None, incremental=False, cache=None):
+        self.download_threads = download_threads
+        self.parse_processes = parse_processes
+        self.inserter = inserter
+        self.incremental = incremental
+        self.cache = cache
+        self.http_session = make_http_session(download_threads)
+        self._downloads = Queue(maxsize=2 * download_threads)
+        # unbounded, so the callbacks of the pool never block its result
+        # handler thread.  A parse slot is held until the writer takes the
+        # result, which bounds the parsed statements waiting to be written.
+        self._writes = Queue()
+        self._parse_slots = threading.BoundedSemaphore(2 * parse_processes)
+        self._received = 0
+        self._in_flight = set()
+        # added to the inserter, but maybe not flushed yet.
+        self._unflushed = []
+        self._flush_count = 0
+        # (window, sequence number of the last statement before its marker)
+        self._markers = []
+        self._idle = threading.Condition()
+
+    def run(self, queue, progress=None, consumer_id=0):
+        """Processes the messages of queue until it receives 'DONE'."""
+        self._progress = progress
+        self._consumer_id = consumer_id
+        self._pool = Pool(self.parse_processes)
+        downloaders = [threading.Thread(target=self._download_loop,
+                                        daemon=True)
+                       for _ in range(self.download_threads)]
+        writer = threading.Thread(target=self._write_loop, daemon=True)
+        for t in downloaders + [writer]:
+            t.start()
+        try:
+            while True:
+                msg = next_message(queue)
+                if msg is None:
+                    continue
+                if isinstance(msg, str) and msg == 'DONE':
+                    break
+                window = checkpoint_window(msg)
+                if window is not None:
+                    with self._idle:
+                        self._markers.append((window, self._received))
+                        self._commit_markers()
+                    continue
+                with self._idle:
+                    self._received += 1
+                    seq = self._received
+                    self._in_flight.add(seq)
+                self._downloads.put((seq, parse_message(msg)))
+            self.wait_until_written()
+            if progress is not None:
+                progress.finish(consumer_id)
+        finally:
+            for _ in downloaders:
+                self._downloads.put(None)
+            self._writes.put(None)
+            for t in downloaders + [writer]:
+                t.join()
+            self._pool.close()
+            self._pool.join()
+        return
+
+    def wait_until_written(self):
+        """Blocks until every financial statement received so far has been
+        inserted and committed."""
+        with self._idle:
+            while len(self._in_flight) > len(self._unflushed):
+                self._idle.wait()
+        flushed = threading.Event()
+        self._writes.put(('FLUSH', flushed))
+        flushed.wait()
+
+    def _commit_markers(self):
+        # called with _idle held.
+        while self._markers and (not self._in_flight or
+                                 self._markers[0][1] < min(self._in_flight)):
+            window, _ = self._markers.pop(0)
+            self._progress.committed(self._consumer_id, window)
+
+    def _done(self, seq):
+        """Records that the financial statement seq failed."""
+        with self._idle:
+            self._in_flight.discard(seq)
+            self._commit_markers()
+            self._idle.notify_all()
+
+    def _written(self, seq):
+        """Records that the financial statement seq was added to the
+        inserter."""
+        with self._idle:
+            self._unflushed.append(seq)
+            self._idle.notify_all()
+        self._flushed()
+
+    def _flushed(self):
+        """Marks the statements added to the inserter as committed if it has
+        flushed since the last call."""
+        if self.inserter.flush_count == self._flush_count:
+            return
+        self._flush_count = self.inserter.flush_count
+        with self._idle:
+            self._in_flight.difference_update(self._unflushed)
+            self._unflushed = []
+            self._commit_markers()
+            self._idle.notify_all()
+
+    def _download_loop(self):
+        while True:
+            item = self._downloads.get()
+            if item is None:
+                return
+            seq, args = item
+            try:
+                self._download(seq, args)
+            except Exception:
+                self._done(seq)
+
+    def _download(self, seq, args):
+        cvrnummer, offentliggoerelsesTidspunkt = args[:2]
+        erst_id, indlaesningsTidspunkt = args[4:]
+        if cvrnummer is None:
+            error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt)
+            self._done(seq)
+            return
+        try:
+            mode = insert_mode(erst_id, indlaesningsTidspunkt,
+                               self.incremental)
+            if mode is None:
+                self._done(seq)
+                return
+            regnskab = InputRegnskab(*args, http_session=self.http_session,
+                                     cache=self.cache)
+        except InputRegnskabError as e:
+            log_input_regnskab_error(e)
+            self._done(seq)
+            return
+        except Exception:
+            log_exception(erst_id)
+            self._done(seq)
+            return
+        # the session stays in this process.
+        regnskab.http_session = None
+        replace = (mode == 'replace')
+
+        def parsed(entries):
+            self._writes.put_nowait(('ADD', seq, regnskab, entries, replace))
+
+        def failed(error):
+            self._parse_slots.release()
+            msg = '[erst_id = %s] Caught Exception while parsing: %r' % (
+                erst_id, error
+            )
+            print(msg, file=sys.stderr, flush=True)
+            self._done(seq)
+
+        self._parse_slots.acquire()
+        self._pool.apply_async(parse_regnskab, (regnskab,), callback=parsed,
+                               error_callback=failed)
+
+    def _write_loop(self):
+        while True:
+            try:
+                item = self._writes.get(timeout=1)
+            except Empty:
+                self.inserter.flush_if_due()
+                self._flushed()
+                continue
+            if item is None:
+                self.inserter.flush()
+                self._flushed()
+                return
+            if item[0] == 'FLUSH':
+                self.inserter.flush()
+                self._flushed()
+                item[1].set()
+                continue
+            _, seq, regnskab, entries, replace = item
+            self._parse_slots.release()
+            try:
+                self.inserter.add_parsed(regnskab, entries, replace=replace)
+            except Exception:
+                log_exception(regnskab.erst_id)
+            finally:
+                self._written(seq)
+
+
+def consumer_staged(queue, unit_handler=None, download_threads=16,
+                    parse_processes=1, batch_size=0, flush_interval=30,
+                    native_load=False, progress=None, consumer_id=0,
+                    incremental=False, cache=None):
+    """Consumes queue with a StagedPipeline.  Unlike the other consumers
+    only one of these is started, and it must not be a daemon process since
+    it starts the parse processes.
+    """
+    engine.dispose()  # for multiprocessing.
+    inserter = make_inserter(batch_size or 10000, flush_interval, native_load)
+    pipeline = StagedPipeline(download_threads=download_threads,
+                              parse_processes=parse_processes,
+                              inserter=inserter, incremental=incremental,
+                              cache=cache)
+    pipeline.run(queue, progress=progress, consumer_id=consumer_id)
+    return
+
+
 def make_input_regnskab_from_search(s):
     r = s.execute()
     result = r[0]
@@ -267,12 +828,17 @@ def retry_generator(g):
                 raise
 
 
-def producer_scan(search_result, queue, queue_lock=None):
+def producer_scan(search_result, queue, known_erst_ids=None):
+    """Puts every financial statement found by search_result on queue,
+    except those whose erst_id is in known_erst_ids.
+    """
     print(search_result)
     print(search_result.to_dict())
 
     for document in retry_generator(search_result.scan()):
         erst_id = document.meta.id
+        if known_erst_ids is not None and erst_id in known_erst_ids:
+            continue
         cvrnummer = document['cvrNummer']
         # cvrnummer is possibly None, e.g. Greenland companies
 
@@ -296,61 +862,275 @@ def producer_scan(search_result, queue, queue_lock=None):
         if xbrl_file_url is not None:
             msg = (cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url,
                    xbrl_extension_url, erst_id, indlaesningsTidspunkt)
-            queue_lock.acquire()
             queue.put(msg)
             popped, pushed = queue.get_statistics()
             print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
                   end='', flush=True, file=sys.stderr)
-            queue_lock.release()
+    queue.flush()
+    return
+
+
+def producer_cache(cache, queue, known_erst_ids=None):
+    """Puts every financial statement in the index of cache on queue,
+    except those whose erst_id is in known_erst_ids."""
+    for msg in cache.messages():
+        erst_id = msg[4]
+        if known_erst_ids is not None and erst_id in known_erst_ids:
+            continue
+        queue.put(msg)
+        popped, pushed = queue.get_statistics()
+        print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
+              end='', flush=True, file=sys.stderr)
+    queue.flush()
     return
 
 
-def get_virk_search(from_date):
+def producer_scan_slice(from_date, to_date, slice_id, slice_count, queue,
+                        known_erst_ids=None,
+                        date_field='offentliggoerelsesTidspunkt'):
+    """Runs producer_scan on slice slice_id of slice_count slices of the
+    scroll, so that several producers can scan the index in parallel.
+    """
+    s = get_scroll_search(from_date, to_date, date_field)
+    s = s.extra(slice={'id': slice_id, 'max': slice_count})
+    producer_scan(s, queue, known_erst_ids=known_erst_ids)
+    return
+
+
+def get_virk_search(from_date, to_date=None,
+                    date_field='offentliggoerelsesTidspunkt'):
     client = Elasticsearch('http://distribution.virk.dk:80',
                            timeout=300,
                            max_retries=10,
                            retry_on_timeout=True,
                            http_compress=True)
     s = Search(using=client, index='offentliggoerelser')
-    s = s.filter('range', offentliggoerelsesTidspunkt={'gte': from_date})
-    s = s.sort('offentliggoerelsesTidspunkt')
+    date_range = {'gte': from_date}
+    if to_date is not None:
+        date_range['lt'] = to_date
+    s = s.filter('range', **{date_field: date_range})
+    s = s.sort(date_field)
 
     return s
 
 
-def fetch_to_db(process_count=1, from_date=datetime(2011, 1, 1)):
-    setup_tables()
-
-    unit_handler = UnitHandler()
-    s = get_virk_search(from_date)
+def get_scroll_search(from_date, to_date=None,
+                      date_field='offentliggoerelsesTidspunkt'):
+    s = get_virk_search(from_date, to_date, date_field)
     params = {'scroll': u'20m', 'size': 256}
-    s = s.params(**params)
+    return s.params(**params)
+
+
+def read_checkpoint(name):
+    session = Session()
+    try:
+        checkpoint = session.query(FetchCheckpoint).get(name)
+        if checkpoint is None:
+            return None
+        return checkpoint.position
+    finally:
+        session.close()
+
+
+def write_checkpoint(name, position):
+    session = Session()
+    try:
+        session.merge(FetchCheckpoint(name=name, position=position))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# How far behind the end of a fetch its checkpoint is kept.  Financial
+# statements become searchable some time after they are indexed, so the last
+# part of the period is fetched again by the next run.
+checkpoint_lag = timedelta(hours=1)
+
+# How far before its checkpoint an incremental fetch starts, for financial
+# statements that became searchable later than checkpoint_lag allows for.
+# Statements that are already stored are skipped, see insert_mode.
+incremental_overlap = timedelta(days=1)
+
+
+def save_checkpoint(name, progress, window_ends, saved, latest):
+    """Stores the end of the last window that every consumer has committed,
+    but no later than latest, if it is later than window saved.  Returns the
+    last window stored."""
+    window = min(progress.lowest(), len(window_ends) - 1)
+    if window > saved:
+        write_checkpoint(name, min(window_ends[window], latest))
+        return window
+    return saved
+
+
+def iter_windows(from_date, to_date, window):
+    """Splits [from_date, to_date) into consecutive windows of length
+    window."""
+    start = from_date
+    while start < to_date:
+        end = min(start + window, to_date)
+        yield start, end
+        start = end
+
+
+def scan_window(from_date, to_date, queue, slice_count=1,
+                known_erst_ids=None, date_field='offentliggoerelsesTidspunkt'):
+    """Puts every financial statement whose date_field is in
+    [from_date, to_date) on queue, scanning slice_count slices in parallel."""
+    if slice_count > 1:
+        producers = [Process(target=producer_scan_slice,
+                             args=(from_date, to_date, slice_id, slice_count,
+                                   queue),
+                             kwargs={'known_erst_ids': known_erst_ids,
+                                     'date_field': date_field},
+                             daemon=True)
+                     for slice_id in range(slice_count)]
+        for p in producers:
+            p.start()
+        for p in producers:
+            p.join()
+    else:
+        producer_scan(get_scroll_search(from_date, to_date, date_field),
+                      queue, known_erst_ids=known_erst_ids)
+    return
+
+
+def fetch_to_db(process_count=1, from_date=datetime(2011, 1, 1),
+                download_engine='sync', concurrency=16, batch_size=0,
+                flush_interval=30, native_load=False, slice_count=1,
+                resume=False, checkpoint_days=30, incremental=False,
+                download_threads=16, cache_dir=None, offline=False):
+    """Fetches every financial statement published since from_date.
+
+    download_engine selects the consumers: process_count 'sync' or 'async'
+    consumer processes, or with 'staged' a single StagedPipeline that parses
+    in process_count processes.
+
+    The period is fetched in windows of checkpoint_days days.  Once every
+    financial statement of a window has been committed by all consumers (see
+    WindowProgress), the end of the window is stored in the fetch_checkpoint
+    table; the consumers never wait for each other.  The period ends now in
+    UTC, and a checkpoint is never later than checkpoint_lag before that.
+    With resume, fetching starts from the stored checkpoint instead of
+    from_date.
+
+    With incremental the windows are over indlaesningsTidspunkt and fetching
+    always starts incremental_overlap before the last incremental checkpoint,
+    if any.  Financial statements that were indexed again since they were
+    stored are replaced.
+
+    With cache_dir the xbrl files are cached in that directory (see
+    xbrl_cache.py).  With offline everything in the cache is inserted without
+    contacting elasticsearch or downloading anything.
+    """
+    if offline and cache_dir is None:
+        raise ValueError('offline requires a cache_dir.')
+    cache = None
+    if cache_dir is not None:
+        cache = XbrlCache(cache_dir, offline=offline)
+    setup_tables()
+    date_field = 'offentliggoerelsesTidspunkt'
+    if incremental:
+        date_field = 'indlaesningsTidspunkt'
+        resume = True
+    checkpoint_name = date_field
+    if resume:
+        checkpoint = read_checkpoint(checkpoint_name)
+        if checkpoint is not None and incremental:
+            checkpoint -= incremental_overlap
+        if checkpoint is not None and checkpoint > from_date:
+            print('Resuming from %s' % checkpoint)
+            from_date = checkpoint
+    # elasticsearch reads dates without a time zone as UTC.
+    to_date = datetime.utcnow()
+    latest_checkpoint = to_date - checkpoint_lag
 
+    unit_handler = None if offline else UnitHandler()
+    known_erst_ids = None
+    if not incremental:
+        # corrected financial statements have known erst_ids.
+        known_erst_ids = KnownErstIds.from_db()
+        print('Found %s financial statements in the database' %
+              len(known_erst_ids))
     try:
         tmp_file = tempfile.NamedTemporaryFile(delete=False)
-        m = IOQueueManager()
-        m.start()
-        queue = m.IOQueue(tmp_file.name)
-        queue_lock = Lock()
-        consumer_partial = functools.partial(consumer_insert,
-                                             queue_lock=queue_lock,
-                                             unit_handler=unit_handler)
+        queue = IOQueue(tmp_file.name)
+        consumer_count = process_count
+        if download_engine == 'staged':
+            consumer_count = 1
+        progress = WindowProgress(consumer_count)
+        if download_engine == 'staged':
+            consumer_partial = functools.partial(consumer_staged,
+                                                 unit_handler=unit_handler,
+                                                 download_threads=download_threads,
+                                                 parse_processes=process_count,
+                                                 batch_size=batch_size,
+                                                 flush_interval=flush_interval,
+                                                 native_load=native_load,
+                                                 progress=progress,
+                                                 incremental=incremental,
+                                                 cache=cache)
+        elif download_engine == 'async':
+            consumer_partial = functools.partial(consumer_insert_async,
+                                                 unit_handler=unit_handler,
+                                                 concurrency=concurrency,
+                                                 batch_size=batch_size,
+                                                 flush_interval=flush_interval,
+                                                 native_load=native_load,
+                                                 progress=progress,
+                                                 incremental=incremental,
+                                                 cache=cache)
+        else:
+            consumer_partial = functools.partial(consumer_insert,
+                                                 unit_handler=unit_handler,
+                                                 batch_size=batch_size,
+                                                 flush_interval=flush_interval,
+                                                 native_load=native_load,
+                                                 progress=progress,
+                                                 incremental=incremental,
+                                                 cache=cache)
 
+        # the staged consumer starts processes of its own.
         processes = [Process(target=consumer_partial,
                              args=(queue,),
-                             daemon=True) for _ in range(process_count)]
+                             kwargs={'consumer_id': consumer_id},
+                             daemon=(download_engine != 'staged'))
+                     for consumer_id in range(consumer_count)]
         for p in processes:
             p.start()
         engine.dispose()  # for multiprocessing.
-        producer_scan(s, queue, queue_lock=queue_lock)
+        window_ends = []
+        saved = -1
+        if offline:
+            # the cache is not ordered by date, so there are no windows.
+            producer_cache(cache, queue, known_erst_ids=known_erst_ids)
+        else:
+            window = timedelta(days=checkpoint_days)
+            for start, end in iter_windows(from_date, to_date, window):
+                scan_window(start, end, queue, slice_count=slice_count,
+                            known_erst_ids=known_erst_ids,
+                            date_field=date_field)
+                window_ends.append(end)
+                for _ in range(consumer_count):
+                    queue.put(('CHECKPOINT', len(window_ends) - 1))
+                queue.flush()
+                saved = save_checkpoint(checkpoint_name, progress,
+                                        window_ends, saved,
+                                        latest_checkpoint)
 
-        queue_lock.acquire()
-        for end in range(process_count):
+        for end in range(consumer_count):
             queue.put('DONE')
-        queue_lock.release()
+        queue.flush()
 
         for p in processes:
             p.join()
+        # a consumer that died has not finished, so its windows are not
+        # saved.
+        save_checkpoint(checkpoint_name, progress, window_ends, saved,
+                        latest_checkpoint)
 
     finally:
         os.remove(tmp_file.name)
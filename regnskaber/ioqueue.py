@@ -1,78 +1,266 @@
-import json
-from multiprocessing import managers
+import mmap
+import os
+import struct
+import time
 
+from multiprocessing import Semaphore, Value
 from queue import Empty
-import sys
+
+# Field tags of the record format.
+_NONE, _STR, _INT = 0, 1, 2
+
+# kind (0: tuple, 1: str, 2: overflow file name), fields.
+_record_header = struct.Struct('<BH')
+_OVERFLOW = 2
+_field_tag = struct.Struct('<B')
+_str_length = struct.Struct('<I')
+_int_value = struct.Struct('<q')
+_slot_header = struct.Struct('<QI')  # sequence number, record length.
+_sequence = struct.Struct('<Q')
+_record_length = struct.Struct('<I')
+_spill_length = struct.Struct('<I')
+
+
+def encode_message(element):
+    """Encodes a str or a tuple of str, int and None as bytes."""
+    if isinstance(element, str):
+        kind, fields = 1, (element,)
+    else:
+        kind, fields = 0, element
+    parts = [_record_header.pack(kind, len(fields))]
+    for field in fields:
+        if field is None:
+            parts.append(_field_tag.pack(_NONE))
+        elif isinstance(field, str):
+            data = field.encode('utf-8')
+            parts.append(_field_tag.pack(_STR))
+            parts.append(_str_length.pack(len(data)))
+            parts.append(data)
+        elif isinstance(field, int):
+            parts.append(_field_tag.pack(_INT))
+            parts.append(_int_value.pack(field))
+        else:
+            raise TypeError('Cannot encode %r' % (field, ))
+    return b''.join(parts)
+
+
+def decode_message(record):
+    kind, field_count = _record_header.unpack_from(record, 0)
+    offset = _record_header.size
+    fields = []
+    for _ in range(field_count):
+        tag, = _field_tag.unpack_from(record, offset)
+        offset += _field_tag.size
+        if tag == _NONE:
+            fields.append(None)
+        elif tag == _STR:
+            length, = _str_length.unpack_from(record, offset)
+            offset += _str_length.size
+            fields.append(bytes(record[offset:offset + length]).decode('utf-8'))
+            offset += length
+        else:
+            value, = _int_value.unpack_from(record, offset)
+            offset += _int_value.size
+            fields.append(value)
+    if kind == _OVERFLOW:
+        return read_overflow(fields[0])
+    if kind == 1:
+        return fields[0]
+    return tuple(fields)
+
+
+def encode_overflow(path):
+    """Encodes a reference to a record stored in the file path."""
+    data = path.encode('utf-8')
+    return b''.join([_record_header.pack(_OVERFLOW, 1),
+                     _field_tag.pack(_STR), _str_length.pack(len(data)),
+                     data])
+
+
+def read_overflow(path):
+    with open(path, 'rb') as fp:
+        record = fp.read()
+    os.remove(path)
+    return decode_message(record)
+
 
 class IOQueue:
-    _buffer_size = 128  # elements.
-
-    def __init__(self, filename):
-        self._push_buffer = []
-        self._pop_buffer = []
-        self._buffer_idx = 0
-        self._popped = 0
-        self._pushed = 0
+    """A queue shared by several producer and consumer processes.
+
+    Messages are stored as fixed width records in a ring of capacity slots in
+    a memory mapped file, so a put or get is a copy into shared memory rather
+    than an IPC round-trip.  The only locks are the ones guarding the head and
+    tail counters, and they are held just long enough to claim a position.
+    Two semaphores count the full and the free slots, so get can block until a
+    message arrives instead of polling.
+
+    Each slot carries a sequence number, as in Vyukov's bounded MPMC queue.
+    The slot of position pos is free for the producer of pos when its number
+    is pos, and holds the message of pos when it is pos + 1; the consumer
+    sets it to pos + capacity, the next position of the slot.  A process that
+    claims a position waits for exactly that number, so a stalled process
+    cannot make another one read a stale message or overwrite an unread one,
+    and messages are got in the order their positions were claimed.
+
+    When the ring is full a producer appends the message to a spill file of its
+    own.  Spilled messages are moved into the ring by later calls to put, and
+    by flush, in the order they were put, so backlogs larger than memory are
+    kept on disk.  A producer must call flush before it stops putting messages.
+
+    A message too large for a slot is written to a file of its own, and the
+    ring holds its file name in its place.  The consumer that gets the message
+    reads and removes the file.
+
+    The queue is passed to other processes as an argument of Process.
+    """
+
+    def __init__(self, filename, capacity=4096, slot_size=1024):
         self._filename = filename
-        self._seek_to = 0
+        self._capacity = capacity
+        self._slot_size = slot_size
+        with open(filename, 'wb') as fp:
+            fp.truncate(capacity * slot_size)
+            for i in range(capacity):
+                fp.seek(i * slot_size)
+                fp.write(_slot_header.pack(i, 0))
+        self._head = Value('Q', 0)
+        self._tail = Value('Q', 0)
+        self._pushed = Value('Q', 0)
+        self._items = Semaphore(0)
+        self._free = Semaphore(capacity)
+        self._open()
+
+    def _open(self):
+        with open(self._filename, 'r+b') as fp:
+            self._mmap = mmap.mmap(fp.fileno(),
+                                   self._capacity * self._slot_size)
+        self._spill = None
+        self._spill_count = 0
+        self._overflow_count = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_mmap']
+        del state['_spill']
+        del state['_spill_count']
+        del state['_overflow_count']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
 
     def get_statistics(self):
-        return self._popped, self._pushed
+        return self._head.value, self._pushed.value
 
     def size(self):
-        return self._pushed - self._popped
+        popped, pushed = self.get_statistics()
+        return pushed - popped
 
-    def get(self):
-        if self._buffer_idx >= len(self._pop_buffer):
-            self._fill_pop_buffer()
-        if len(self._pop_buffer) > self._buffer_idx:
-            self._buffer_idx += 1
-            self._popped += 1
-            return self._pop_buffer[self._buffer_idx - 1]
-        raise Empty
+    def get(self, block=True, timeout=None):
+        """Removes and returns the oldest message.
+
+        If block is true, waits up to timeout seconds (forever if timeout is
+        None) for a message to arrive.  Raises queue.Empty if there is none.
+        """
+        if not self._items.acquire(block, timeout):
+            raise Empty
+        position = self._claim(self._head)
+        offset = self._offset(position)
+        # the producer of position may still be writing the slot.
+        self._wait_for_sequence(offset, position + 1)
+        length, = _record_length.unpack_from(self._mmap,
+                                             offset + _sequence.size)
+        start = offset + _slot_header.size
+        record = self._mmap[start:start + length]
+        self._set_sequence(offset, position + self._capacity)
+        self._free.release()
+        return decode_message(record)
 
     def put(self, element):
-        if len(self._push_buffer) >= IOQueue._buffer_size:
-            self._flush_buffer()
-        assert(len(self._push_buffer) < IOQueue._buffer_size)
-        self._push_buffer.append(element)
-        self._pushed += 1
-
-    def _fill_pop_buffer(self):
-        assert(self._buffer_idx >= len(self._pop_buffer))
-        if self.size() < IOQueue._buffer_size:
-            self._pop_buffer = [x for x in self._push_buffer]
-            self._push_buffer = []
-            self._buffer_idx = 0
-            return
-
-        with open(self._filename) as qfile:
-            qfile.seek(self._seek_to)
-            contents = qfile.readline()
-            assert contents.endswith('\n')
-            self._seek_to = qfile.tell()
-
-            try:
-                self._pop_buffer = [x for x in json.loads(contents)]
-            except json.JSONDecodeError as e:
-                print(contents, file=sys.stderr)
-                raise
-            self._pop_buffer = [tuple(x) if type(x) == list else x
-                                 for x in self._pop_buffer]
-            self._buffer_idx = 0
-            return
-
-    def _flush_buffer(self):
-        assert(len(self._push_buffer) > 0)
-        with open(self._filename, 'a') as qfile:
-            to_write = json.dumps(self._push_buffer)
-            assert '\n' not in to_write
-            print(to_write, file=qfile)
-            self._push_buffer = []
-
-
-class IOQueueManager(managers.BaseManager):
-    pass
-
-
-IOQueueManager.register('IOQueue', IOQueue)
+        record = encode_message(element)
+        if len(record) > self._slot_size - _slot_header.size:
+            record = self._overflow_record(record)
+        with self._pushed.get_lock():
+            self._pushed.value += 1
+        self._drain_spill()
+        if self._spill_count or not self._push(record):
+            self._spill_record(record)
+
+    def flush(self):
+        """Blocks until every message spilled by this process is in the
+        ring."""
+        self._drain_spill(block=True)
+
+    def _claim(self, counter):
+        """Returns the next position of counter, the head or the tail."""
+        with counter.get_lock():
+            position = counter.value
+            counter.value += 1
+        return position
+
+    def _offset(self, position):
+        return (position % self._capacity) * self._slot_size
+
+    def _wait_for_sequence(self, offset, sequence):
+        """Waits until the slot at offset has the sequence number
+        sequence."""
+        # The slot is claimed, and the process holding it is at most a copy of
+        # a record away from releasing it.
+        while _sequence.unpack_from(self._mmap, offset)[0] != sequence:
+            time.sleep(0.0001)
+
+    def _set_sequence(self, offset, sequence):
+        # written last, so the slot is complete once the number changes.
+        _sequence.pack_into(self._mmap, offset, sequence)
+
+    def _push(self, record, block=False):
+        if not self._free.acquire(block):
+            return False
+        position = self._claim(self._tail)
+        offset = self._offset(position)
+        # the consumer of the previous lap may still be reading the slot.
+        self._wait_for_sequence(offset, position)
+        start = offset + _slot_header.size
+        self._mmap[start:start + len(record)] = record
+        _record_length.pack_into(self._mmap, offset + _sequence.size,
+                                 len(record))
+        self._set_sequence(offset, position + 1)
+        self._items.release()
+        return True
+
+    def _overflow_record(self, record):
+        path = '%s.overflow.%d.%d' % (self._filename, os.getpid(),
+                                      self._overflow_count)
+        self._overflow_count += 1
+        with open(path, 'wb') as fp:
+            fp.write(record)
+        return encode_overflow(path)
+
+    def _spill_filename(self):
+        return '%s.spill.%d' % (self._filename, os.getpid())
+
+    def _spill_record(self, record):
+        if self._spill is None:
+            self._spill = open(self._spill_filename(), 'w+b')
+            self._spill_read = 0
+        self._spill.seek(0, os.SEEK_END)
+        self._spill.write(_spill_length.pack(len(record)))
+        self._spill.write(record)
+        self._spill_count += 1
+
+    def _drain_spill(self, block=False):
+        while self._spill_count:
+            self._spill.seek(self._spill_read)
+            length, = _spill_length.unpack(
+                self._spill.read(_spill_length.size)
+            )
+            record = self._spill.read(length)
+            if not self._push(record, block):
+                return
+            self._spill_read += _spill_length.size + length
+            self._spill_count -= 1
+        if self._spill is not None:
+            self._spill.close()
+            os.remove(self._spill_filename())
+            self._spill = None
@@ -1,18 +1,23 @@
 import datetime
+import hashlib
 import json
 
-from itertools import groupby
-from pprint import pprint
+from multiprocessing import Pool
 
-from .shared import financial_statement_iterator, partition_consolidated
+from . import columnar, parquet_sink
+from .shared import (financial_statement_iterator, partition_consolidated,
+                     get_number_of_rows, get_max_id, id_ranges,
+                     check_entry_index, init_worker)
 
-from sqlalchemy import Table, Column, ForeignKey, MetaData
+from sqlalchemy import Table, Column, ForeignKey, MetaData, exists, select
+from sqlalchemy import and_
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy import DateTime, String, Text
 from sqlalchemy import Sequence, UniqueConstraint
 from sqlalchemy import BigInteger, Boolean, Float, Integer
 
 
-from .models import Base
+from .models import Base, FeatureTableState, FinancialStatement
 from . import Session, engine
 
 current_regnskabs_id = 0
@@ -180,15 +185,9 @@ class Header(Base):
     )
 
 
-def make_header(fs_dict, financial_statement_id, consolidated, session):
-    instance = session.query(Header).filter(
-        Header.financial_statement_id == financial_statement_id,
-        Header.consolidated == consolidated
-    ).first()
-
-    if instance:
-        return instance
-
+def make_header_values(fs_dict, financial_statement_id, consolidated):
+    """Returns the column values of the Header row of the financial
+    statement (or its consolidated part) in fs_dict."""
     header_values = {
         'financial_statement_id': financial_statement_id,
         'language': find_language(fs_dict),
@@ -236,10 +235,37 @@ def make_header(fs_dict, financial_statement_id, consolidated, session):
     except ValueError:
         header_values['cmn_TypeOfAuditorAssistance'] = None
 
-    header = Header(**header_values)
-    session.add(header)
-    session.commit()
-    return header
+    return header_values
+
+
+def ensure_headers(parts):
+    """Makes sure there is a Header row for each (financial_statement_id,
+    consolidated, fs_dict) triple in parts.  The existing rows are looked up
+    with one query and the missing ones inserted with one executemany.
+
+    Returns a dict from (financial_statement_id, consolidated) to Header.id.
+    """
+    header_table = Header.__table__
+    fs_ids = list({fs_id for fs_id, _, _ in parts})
+
+    def lookup():
+        q = select([header_table.c.financial_statement_id,
+                    header_table.c.consolidated, header_table.c.id]).where(
+            header_table.c.financial_statement_id.in_(fs_ids)
+        )
+        return {(fs_id, bool(consolidated)): header_id
+                for fs_id, consolidated, header_id in engine.execute(q)}
+
+    if not parts:
+        return {}
+    header_ids = lookup()
+    missing = [make_header_values(fs_dict, fs_id, consolidated)
+               for fs_id, consolidated, fs_dict in parts
+               if (fs_id, consolidated) not in header_ids]
+    if missing:
+        engine.execute(header_table.insert(), missing)
+        header_ids = lookup()
+    return header_ids
 
 
 def create_table(table_description, drop_table=False):
@@ -287,77 +313,301 @@ def create_table(table_description, drop_table=False):
     return t
 
 
-def populate_row(table_description, fs_entries, fs_id,
-                 consolidated=False):
+def make_fs_dict(fs_entries):
+    """Returns a dict from fieldName to the entries with that fieldName, in
+    the order of fs_entries."""
+    fs_dict = {}
+    for entry in fs_entries:
+        fs_dict.setdefault(entry.fieldName, []).append(entry)
+    return fs_dict
+
+
+def bind_method(method, fieldName, options):
+    """Returns method with fieldName and the keyword options bound, called
+    with just the fs_dict."""
+    def bound(fs_dict):
+        return method(fs_dict, fieldName, **options)
+    return bound
+
+
+class ExtractionPlan(object):
+    """The columns of a table description compiled for computing rows.
+
+    Each column's method is resolved and bound to its fieldName and options
+    once, and the columns are indexed by fieldName, so computing a row only
+    calls the methods of the fieldNames present in the financial statement.
+    The built-in methods are pure, and for an absent fieldName their value
+    is computed once here; methods added with register_method are always
+    called.
+
+    key is the column_description key used for the keys of the rows,
+    'name' for make_feature_table and 'regnskabs_fieldname' for
+    make_feature_table_json.  With numeric_engine 'numpy' the generic_number
+    columns are left out of values and listed in number_columns as
+    (key, fieldName, dimensions) triples for columnar.number_columns.
     """
-    returns a dict with keys based on table_description and values
-    read from regnskab_tuples based on the method in table_description
+
+    builtin_methods = ('generic_number', 'generic_text', 'generic_date')
+
+    def __init__(self, table_description, key='name',
+                 numeric_engine='python'):
+        self.defaults = {}
+        self.by_fieldName = {}
+        self.always = []
+        self.number_columns = []
+        for column_description in table_description['columns']:
+            methodname = column_description['method']['name']
+            assert methodname in method_translation.keys()
+            dimensions = column_description['dimensions']
+            regnskabs_fieldname = column_description['regnskabs_fieldname']
+            column_key = column_description[key]
+            if (methodname == 'generic_number' and
+                    numeric_engine == 'numpy'):
+                self.number_columns.append(
+                    (column_key, regnskabs_fieldname, dimensions)
+                )
+                continue
+            options = {'dimensions': dimensions}
+            if 'when_multiple' in column_description['method'].keys():
+                options['when_multiple'] = (
+                    column_description['method']['when_multiple']
+                )
+            method = bind_method(method_translation[methodname],
+                                 regnskabs_fieldname, options)
+            column = (column_key, method)
+            if methodname in self.builtin_methods:
+                self.defaults[column_key] = method({})
+                self.by_fieldName.setdefault(regnskabs_fieldname,
+                                             []).append(column)
+            else:
+                self.always.append(column)
+
+    def values(self, fs_dict):
+        """returns a dict from column key to the value computed from
+        fs_dict"""
+        result = dict(self.defaults)
+        by_fieldName = self.by_fieldName
+        for fieldName in fs_dict:
+            for column_key, method in by_fieldName.get(fieldName, ()):
+                result[column_key] = method(fs_dict)
+        for column_key, method in self.always:
+            result[column_key] = method(fs_dict)
+        return result
+
+
+def chunk_rows(plans, statements):
+    """Returns the rows of a chunk of financial statements, a list of
+    (fs_id, fs_entries) pairs, for each ExtractionPlan in plans.  Each
+    statement has one row for the consolidated entries and one for the
+    rest, if there are any.
+
+    The Header rows of the whole chunk are looked up and inserted together,
+    see ensure_headers, and shared by all the tables.  The number_columns of
+    the plans are computed for the whole chunk at once by
+    columnar.number_columns.
     """
     global current_regnskabs_id
-    current_regnskabs_id = fs_id
-    fs_dict = dict([(k, list(v))
-                    for k, v in groupby(fs_entries,
-                                        lambda k: k.fieldName)])
-    session = Session()
-    header = make_header(fs_dict, fs_id, consolidated, session)
-    result = {'headerId': header.id}
-    session.close()
+    parts = []
+    for fs_id, fs_entries in statements:
+        fs_entries_cons, fs_entries_solo = partition_consolidated(fs_entries)
+        if len(fs_entries_cons):
+            parts.append((fs_id, True, make_fs_dict(fs_entries_cons)))
+        if len(fs_entries_solo):
+            parts.append((fs_id, False, make_fs_dict(fs_entries_solo)))
+    header_ids = ensure_headers(parts)
+    fs_dicts = [fs_dict for _, _, fs_dict in parts]
+    numbers = [columnar.number_columns(fs_dicts, plan.number_columns,
+                                       generic_number)
+               if plan.number_columns else {}
+               for plan in plans]
+    rows = [[] for _ in plans]
+    for i, (fs_id, consolidated, fs_dict) in enumerate(parts):
+        current_regnskabs_id = fs_id
+        header_id = header_ids[(fs_id, consolidated)]
+        for table_rows, plan, table_numbers in zip(rows, plans, numbers):
+            row = {'headerId': header_id}
+            row.update(plan.values(fs_dict))
+            for column_name, values in table_numbers.items():
+                row[column_name] = values[i]
+            table_rows.append(row)
+    return rows
+
+
+def iter_chunks(fs_iterator, chunk_size=500):
+    """Groups the (i, end, fs_id, fs_entries) tuples of a
+    financial_statement_iterator into lists of (fs_id, fs_entries) pairs.
+    Yields (i, end, chunk) with i and end of the last statement of
+    chunk."""
+    chunk = []
+    i = end = None
+    for i, end, fs_id, fs_entries in fs_iterator:
+        chunk.append((fs_id, fs_entries))
+        if len(chunk) >= chunk_size:
+            yield i, end, chunk
+            chunk = []
+    if chunk:
+        yield i, end, chunk
 
-    for column_description in table_description['columns']:
-        methodname = column_description['method']['name']
-        assert methodname in method_translation.keys()
-        dimensions = column_description['dimensions']
-        regnskabs_fieldname = column_description['regnskabs_fieldname']
-        column_name = column_description['name']
-        if 'when_multiple' in column_description['method'].keys():
-            when_multiple = column_description['method']['when_multiple']
-            result[column_name] = method_translation[methodname](
-                fs_dict,
-                regnskabs_fieldname,
-                dimensions=dimensions,
-                when_multiple=when_multiple
-            )
-        else:
-            result[column_name] = method_translation[methodname](
-                fs_dict,
-                regnskabs_fieldname,
-                dimensions=dimensions,
-            )
-            
-    return result
 
+class SqlSink(object):
+    """Inserts rows into a table in the database."""
 
-def populate_table(table_description, table):
-    assert(isinstance(table_description, dict))
-    assert(isinstance(table, Table))
-    print("Populating table %s" % table_description['tablename'])
-    cache = []
+    def __init__(self, table):
+        self.table = table
+
+    def write(self, rows):
+        engine.execute(self.table.insert(), rows)
+
+    def close(self):
+        pass
+
+
+def parse_output(output):
+    """Splits an output specification, None for the database or
+    'parquet:<directory>', into (kind, directory)."""
+    if output is None:
+        return 'sql', None
+    kind, _, directory = output.partition(':')
+    if kind != 'parquet' or not directory:
+        raise ValueError('Unknown output %r, expected parquet:<directory>'
+                         % (output, ))
+    return kind, directory
+
+
+def make_sink(table, output=None, part=1):
+    """Returns the sink that the rows of table are written to, see
+    parse_output.  part names the files of a file sink."""
+    kind, directory = parse_output(output)
+    if kind == 'parquet':
+        return parquet_sink.ParquetSink(directory, table, Header.__table__,
+                                        part)
+    return SqlSink(table)
+
+
+def existing_rows(table, rows):
+    """Returns the set of headerIds of rows that are in table already."""
+    header_ids = [row['headerId'] for row in rows]
+    if not header_ids:
+        return set()
+    q = select([table.c.headerId]).where(table.c.headerId.in_(header_ids))
+    return {header_id for header_id, in engine.execute(q)}
+
+
+def insert_rows(tables, fs_iterator, progress=None, numeric_engine='python',
+                output=None, part=1, known_until=0):
+    """Inserts the rows of every financial statement from fs_iterator into
+    every table in tables, a list of (table_description, table) pairs, so
+    each statement is read once however many tables there are.  Calls
+    progress(i, end) before each chunk.  Returns the number of financial
+    statements processed.  numeric_engine is passed on to ExtractionPlan,
+    output and part to make_sink.
+
+    Financial statements with id <= known_until may have rows in the
+    tables already; those rows are left out.
+    """
+    plans = [ExtractionPlan(table_description, numeric_engine=numeric_engine)
+             for table_description, _ in tables]
+    sinks = [make_sink(table, output, part) for _, table in tables]
+    caches = [[] for _ in tables]
     cache_sz = 2000
-    fs_iterator = financial_statement_iterator()
+    count = 0
+    for i, end, chunk in iter_chunks(fs_iterator):
+        if progress is not None:
+            progress(i, end)
+        chunk_tables = chunk_rows(plans, chunk)
+        if chunk[0][0] <= known_until:
+            for (_, table), rows in zip(tables, chunk_tables):
+                existing = existing_rows(table, rows)
+                rows[:] = [row for row in rows
+                           if row['headerId'] not in existing]
+        for cache, rows in zip(caches, chunk_tables):
+            cache.extend(rows)
+        count += len(chunk)
+        for sink, cache in zip(sinks, caches):
+            if len(cache) >= cache_sz:
+                sink.write(cache)
+                del cache[:]
+    for sink, cache in zip(sinks, caches):
+        if len(cache):
+            sink.write(cache)
+        sink.close()
+    return count
+
+
+def populate_range(table_descriptions, start_idx, end_idx,
+                   numeric_engine='python', output=None, known_until=0):
+    """Inserts the rows of the financial statements with start_idx <= id <
+    end_idx into the tables of table_descriptions.  Returns the number of
+    financial statements processed.  See insert_rows for known_until.
+
+    Runs in the worker processes of populate_tables, each of which inserts
+    its own rows.
+    """
+    tables = [(table_description, create_table(table_description))
+              for table_description in table_descriptions]
+    fs_iterator = financial_statement_iterator(end_idx, start_idx=start_idx)
+    return insert_rows(tables, fs_iterator, numeric_engine=numeric_engine,
+                       output=output, part=start_idx, known_until=known_until)
+
+
+def populate_range_star(args):
+    return populate_range(*args)
+
 
+def populate_tables(tables, workers=1, numeric_engine='python',
+                    start_idx=1, end_idx=None, output=None, known_until=0):
+    """Fills every table in tables, a list of (table_description, table)
+    pairs, with a row per financial statement (and consolidation) with
+    start_idx <= id < end_idx, in a single pass over the financial
+    statements.
+
+    With several workers the financial_statement ids are split into ranges
+    that are processed by a pool of worker processes, one range per worker
+    for Parquet output.
+
+    numeric_engine is 'python' or 'numpy', see ExtractionPlan.  output
+    is where the rows go, see parse_output.  See insert_rows for
+    known_until.
+    """
+    for table_description, table in tables:
+        assert(isinstance(table_description, dict))
+        assert(isinstance(table, Table))
+    print("Populating tables %s" % ', '.join(
+        table_description['tablename'] for table_description, _ in tables
+    ))
     ERASE = '\r\x1B[K'
     progress_template = "Processing financial statements %s/%s"
-    for i, end, fs_id, fs_entries in fs_iterator:
+
+    def progress(i, end):
         print(ERASE, end='', flush=True)
         print(progress_template % (i, end), end='', flush=True)
-        partition = partition_consolidated(fs_entries)
-        fs_entries_cons, fs_entries_solo = partition
-        if len(fs_entries_cons):
-            row_values = populate_row(table_description, fs_entries_cons,
-                                      fs_id, consolidated=True)
-            if row_values:
-                cache.append(row_values)
-        if len(fs_entries_solo):
-            row_values = populate_row(table_description, fs_entries_solo,
-                                      fs_id, consolidated=False)
-            if row_values:
-                cache.append(row_values)
-        if len(cache) >= cache_sz:
-            engine.execute(table.insert(), cache)
-            cache = []
-    if len(cache):
-        engine.execute(table.insert(), cache)
-        cache = []
+
+    if workers > 1:
+        table_descriptions = [table_description
+                              for table_description, _ in tables]
+        total_rows = get_number_of_rows(start_idx, end_idx)
+        range_size = 10000
+        if parse_output(output)[0] == 'parquet':
+            # a range per worker, so each worker writes one file per
+            # partition, see parquet_sink.
+            range_size = max(1, -(-total_rows // workers))
+        ranges = id_ranges(range_size, start_idx=start_idx, end_idx=end_idx)
+        tasks = [(table_descriptions, start_idx, end_idx, numeric_engine,
+                  output, known_until)
+                 for start_idx, end_idx in ranges]
+        engine.dispose()  # for multiprocessing.
+        done = 0
+        with Pool(workers, initializer=init_worker) as pool:
+            for count in pool.imap_unordered(populate_range_star, tasks):
+                done += count
+                progress(done, total_rows)
+        print(flush=True)
+        return
+
+    fs_iterator = financial_statement_iterator(end_idx, start_idx=start_idx)
+    insert_rows(tables, fs_iterator, progress=progress,
+                numeric_engine=numeric_engine, output=output, part=start_idx,
+                known_until=known_until)
     print(flush=True)
     return
 
@@ -424,21 +674,153 @@ def fieldname_to_colname(fieldname):
 
 
 def register_method(name, func):
-    global method_translation
     assert name not in ['generic_date', 'generic_number', 'generic_text']
     method_translation[name] = func
 
 
-def main(table_descriptions_file):
+# How many financial_statement ids before the last run an incremental
+# transform reads again, see main.
+incremental_margin = 10000
+
+
+def table_description_hash(table_description):
+    """Returns the sha256 of table_description as sorted json."""
+    encoded = json.dumps(table_description, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def delete_replaced_rows(table):
+    """Deletes the rows of table whose financial statement no longer
+    exists, e.g. because an incremental fetch replaced it with a corrected
+    one under a new id."""
+    header_table = Header.__table__
+    statement_table = FinancialStatement.__table__
+    stale_headers = select([header_table.c.id]).where(
+        ~exists().where(
+            statement_table.c.id == header_table.c.financial_statement_id
+        )
+    )
+    engine.execute(table.delete().where(
+        table.c.headerId.in_(stale_headers)
+    ))
+
+
+def delete_replaced_headers():
+    """Deletes the Header rows whose financial statement no longer exists
+    and that no table in the database refers to any more.  Rows of replaced
+    statements in tables that are not being rebuilt keep their Header row
+    until delete_replaced_rows has removed them."""
+    header_table = Header.__table__
+    statement_table = FinancialStatement.__table__
+    conditions = [~exists().where(
+        statement_table.c.id == header_table.c.financial_statement_id
+    )]
+    inspector = Inspector.from_engine(engine)
+    metadata = MetaData()
+    for tablename in inspector.get_table_names():
+        for foreign_key in inspector.get_foreign_keys(tablename):
+            if foreign_key['referred_table'] != header_table.name:
+                continue
+            column_name = foreign_key['constrained_columns'][0]
+            table = Table(tablename, metadata, Column(column_name, Integer),
+                          extend_existing=True)
+            conditions.append(~exists().where(
+                table.c[column_name] == header_table.c.id
+            ))
+    engine.execute(header_table.delete().where(and_(*conditions)))
+
+
+def main(table_descriptions_file, workers=1, numeric_engine='python',
+         incremental=False, output=None):
+    """Creates and populates the tables in the table descriptions file.
+
+    With incremental, a table whose table description is unchanged since the
+    last run (see FeatureTableState) only gets rows for the financial
+    statements added since, and loses the rows of statements that were
+    replaced.  A fetch may commit a statement after one with a larger id, so
+    the last incremental_margin statements before the previous run are read
+    again and get the rows they are missing.  Other tables are rebuilt from scratch.  Every run to the
+    database records how far each table is populated, so an incremental run
+    continues from a full run as well.
+
+    With output 'parquet:<directory>' the tables are written as Parquet
+    files in directory instead of to the database, see parquet_sink.
+    """
+    kind, directory = parse_output(output)
+    if kind == 'parquet':
+        parquet_sink.check_pyarrow()
+        if incremental:
+            raise ValueError('incremental is not supported for %s output'
+                             % kind)
     Base.metadata.create_all(engine)
-    tables = dict()
+    check_entry_index()
 
     with open(table_descriptions_file) as fp:
         table_descriptions = json.load(fp)
 
+    max_id = get_max_id()
+    if max_id is None:
+        return
+    end_idx = max_id + 1
+    # tables grouped by the first financial_statement_id they need and the
+    # last one they were populated with.
+    passes = {}
     for t in table_descriptions:
-        table = create_table(t, drop_table=True)
-        populate_table(t, table)
-        tables[t['tablename']] = table
+        start_idx, known_until = 1, 0
+        if incremental:
+            state = read_table_state(t['tablename'])
+            if (state is not None and
+                    state[0] == table_description_hash(t) and
+                    engine.has_table(t['tablename'])):
+                known_until = state[1]
+                start_idx = max(1, known_until + 1 - incremental_margin)
+        if kind == 'parquet':
+            table = create_table(t)
+            parquet_sink.remove_table(directory, table.name)
+        else:
+            table = create_table(t, drop_table=(known_until == 0))
+        if known_until:
+            delete_replaced_rows(table)
+        passes.setdefault((start_idx, known_until), []).append((t, table))
+    delete_replaced_headers()
+
+    for (start_idx, known_until), tables in sorted(passes.items()):
+        if start_idx < end_idx:
+            populate_tables(tables, workers=workers,
+                            numeric_engine=numeric_engine,
+                            start_idx=start_idx, end_idx=end_idx,
+                            output=output, known_until=known_until)
+        if kind == 'sql':
+            for t, _ in tables:
+                write_table_state(t, max_id)
 
     return
+
+
+def read_table_state(tablename):
+    """Returns (tdf_hash, last_financial_statement_id) of tablename, or None
+    if it has not been populated in the database."""
+    session = Session()
+    try:
+        state = session.query(FeatureTableState).get(tablename)
+        if state is None:
+            return None
+        return state.tdf_hash, state.last_financial_statement_id
+    finally:
+        session.close()
+
+
+def write_table_state(table_description, last_financial_statement_id):
+    session = Session()
+    try:
+        session.merge(FeatureTableState(
+            tablename=table_description['tablename'],
+            tdf_hash=table_description_hash(table_description),
+            last_financial_statement_id=last_financial_statement_id
+        ))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
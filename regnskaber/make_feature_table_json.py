@@ -1,66 +1,51 @@
-import datetime
 import json
 
-from itertools import groupby
-
 from .shared import financial_statement_iterator, partition_consolidated, tag_previous_reporting_period
-from .make_feature_table import generic_text, make_header, Header, register_method, method_translation
+from .make_feature_table import Header
+from .make_feature_table import make_fs_dict, ensure_headers, iter_chunks
+from .make_feature_table import ExtractionPlan
 
 from sqlalchemy import Table, Column, ForeignKey, MetaData
 from sqlalchemy import JSON, Integer
-import pdb
-
 
 from .models import Base
-from . import Session, engine
+from . import engine
 
 current_regnskabs_id = 0
 
 
-def populate_row(table_description, fs_entries, fs_id,
-                 consolidated=False):
-    """
-    returns a dict with keys based on table_description and values
-    read from regnskab_tuples based on the method in table_description
-    """
+def make_plan(table_description):
+    return ExtractionPlan(table_description, key='regnskabs_fieldname')
+
+
+def plan_data(plan, fs_dict):
+    return {fieldName: value
+            for fieldName, value in plan.values(fs_dict).items()
+            if value is not None}
+
+
+def chunk_rows(plan, statements):
+    """Returns a row for each financial statement in statements, a list of
+    (fs_id, fs_entries) pairs, computed by plan, an ExtractionPlan.  The
+    Header rows of the whole chunk are looked up and inserted together, see
+    make_feature_table.ensure_headers."""
     global current_regnskabs_id
-    current_regnskabs_id = fs_id
-    # print('current regnskabs id')
-    fs_dict = dict([(k, list(v))
-                    for k, v in groupby(fs_entries,
-                                        lambda k: k.fieldName)])
-    session = Session()
-    header = make_header(fs_dict, fs_id, consolidated, session)
-    result = {'headerId': header.id}
-    session.close()
-    data = {}
-    for column_description in table_description['columns']:
-        methodname = column_description['method']['name']
-        assert methodname in method_translation.keys()
-        dimensions = column_description['dimensions']
-        regnskabs_fieldname = column_description['regnskabs_fieldname']
-        column_name = regnskabs_fieldname
-
-        if 'when_multiple' in column_description['method'].keys():
-            when_multiple = column_description['method']['when_multiple']
-            #data[column_name]
-            out = method_translation[methodname](
-                fs_dict,
-                regnskabs_fieldname,
-                dimensions=dimensions,
-                when_multiple=when_multiple
-            )
+    parts = []
+    for fs_id, fs_entries in statements:
+        fs_entries_cons, fs_entries_solo = partition_consolidated(fs_entries)
+        # if there is consolidated then that is what we need to use
+        if len(fs_entries_cons):
+            parts.append((fs_id, True, make_fs_dict(fs_entries_cons)))
         else:
-            #data[column_name]
-            out = method_translation[methodname](
-                fs_dict,
-                regnskabs_fieldname,
-                dimensions=dimensions,
-            )
-        if out is not None:
-            data[column_name] = out
-    result['data'] = data
-    return result
+            assert len(fs_entries_solo)
+            parts.append((fs_id, False, make_fs_dict(fs_entries_solo)))
+    header_ids = ensure_headers(parts)
+    rows = []
+    for fs_id, consolidated, fs_dict in parts:
+        current_regnskabs_id = fs_id
+        rows.append({'headerId': header_ids[(fs_id, consolidated)],
+                     'data': plan_data(plan, fs_dict)})
+    return rows
 
 
 def populate_table(table_description, table):
@@ -70,25 +55,13 @@ def populate_table(table_description, table):
     cache = []
     cache_sz = 1000
     fs_iterator = financial_statement_iterator(data_transform=tag_previous_reporting_period)
+    plan = make_plan(table_description)
     ERASE = '\r\x1B[K'
     progress_template = "Processing financial statements %s/%s"
-    for i, end, fs_id, fs_entries in fs_iterator:
+    for i, end, chunk in iter_chunks(fs_iterator):
         print(ERASE, end='', flush=True)
         print(progress_template % (i, end), end='', flush=True)
-        partition = partition_consolidated(fs_entries)
-        fs_entries_cons, fs_entries_solo = partition
-        # if there is consolidated then that is what we need to use
-        if len(fs_entries_cons):
-            row_values = populate_row(table_description, fs_entries_cons,
-                                      fs_id, consolidated=True)
-            if row_values:
-                cache.append(row_values)
-        else:
-            assert len(fs_entries_solo)
-            row_values = populate_row(table_description, fs_entries_solo,
-                                      fs_id, consolidated=False)
-            if row_values:
-                cache.append(row_values)
+        cache.extend(chunk_rows(plan, chunk))
         if len(cache) >= cache_sz:
             engine.execute(table.insert(), cache)
             cache = []
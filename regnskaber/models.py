@@ -32,7 +32,8 @@ class FinancialStatementEntry(Base):
 
     id = Column(Integer, Sequence('id_sequence'), primary_key=True)
     financial_statement_id = Column(Integer,
-                                    ForeignKey('financial_statement.id'))
+                                    ForeignKey('financial_statement.id'),
+                                    index=True)
     fieldName = Column(String(length=1000))
     fieldValue = Column(Text(length=2**32-1, convert_unicode=True))
     decimals = Column(String(length=20))
@@ -49,3 +50,77 @@ class FinancialStatementEntry(Base):
     )
 
     __table_args__ = {'mysql_row_format': 'COMPRESSED'}
+
+
+class FieldName(Base):
+    """A distinct fieldName of the normalised schema, see normalised.py."""
+
+    __tablename__ = 'entry_field_name'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(String(length=1000))
+    value_hash = Column(String(length=40), unique=True)
+
+
+class DimensionSet(Base):
+    """A distinct dimensions of the normalised schema, see normalised.py."""
+
+    __tablename__ = 'entry_dimensions'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(String(length=10000))
+    value_hash = Column(String(length=40), unique=True)
+
+
+class Unit(Base):
+    """A distinct unitIdXbrl of the normalised schema, see normalised.py."""
+
+    __tablename__ = 'entry_unit'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(String(length=100))
+    value_hash = Column(String(length=40), unique=True)
+
+
+class NormalisedEntry(Base):
+    """A financial_statement_entry of the normalised schema, with fieldName,
+    dimensions and unitIdXbrl stored as ids of their lookup tables."""
+
+    __tablename__ = 'normalised_entry'
+
+    id = Column(Integer, Sequence('id_sequence'), primary_key=True)
+    financial_statement_id = Column(Integer,
+                                    ForeignKey('financial_statement.id'),
+                                    index=True)
+    fieldName_id = Column(Integer, ForeignKey('entry_field_name.id'))
+    fieldValue = Column(Text(length=2**32-1, convert_unicode=True))
+    decimals = Column(String(length=20))
+    cvrnummer = Column(BigInteger)
+    startDate = Column(DateTime)
+    endDate = Column(DateTime)
+    dimensions_id = Column(Integer, ForeignKey('entry_dimensions.id'))
+    unitIdXbrl_id = Column(Integer, ForeignKey('entry_unit.id'))
+    koncern = Column(Integer)
+
+    __table_args__ = {'mysql_row_format': 'COMPRESSED'}
+
+
+class FetchCheckpoint(Base):
+    """The position up to which fetch has committed every financial
+    statement, see fetch.fetch_to_db."""
+
+    __tablename__ = 'fetch_checkpoint'
+
+    name = Column(String(length=100), primary_key=True)
+    position = Column(DateTime)
+
+
+class FeatureTableState(Base):
+    """How far transform has populated a feature table in the database, see
+    make_feature_table.main."""
+
+    __tablename__ = 'feature_table_state'
+
+    tablename = Column(String(length=100), primary_key=True)
+    tdf_hash = Column(String(length=64))
+    last_financial_statement_id = Column(Integer)
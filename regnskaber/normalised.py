@@ -0,0 +1,145 @@
+""" The optional normalised schema of the financial statement entries.
+
+In the default 'wide' schema every financial_statement_entry row stores its
+fieldName, dimensions and unitIdXbrl as strings.  In the 'normalised' schema
+the entries go to normalised_entry instead, which stores the ids of rows in
+the lookup tables entry_field_name, entry_dimensions and entry_unit.  The
+schema is chosen with schema = normalised in config.ini, see
+regnskaber.use_schema.
+
+Each process caches the lookup tables as far as it has seen them, so inserting
+entries only queries the lookup tables for values that are new to the
+process, and reading entries only for ids that are new to it, once per chunk
+of rows.
+"""
+import hashlib
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from .models import (DimensionSet, FieldName, FinancialStatementEntry,
+                     NormalisedEntry, Unit)
+from . import engine, get_schema
+
+
+def is_normalised():
+    return get_schema() == 'normalised'
+
+
+def entry_table():
+    """Returns the table the entries are stored in."""
+    if is_normalised():
+        return NormalisedEntry.__table__
+    return FinancialStatementEntry.__table__
+
+
+def value_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class Lookup(object):
+    """The rows of a lookup table, cached in both directions."""
+
+    query_size = 1000
+
+    def __init__(self, model):
+        self.table = model.__table__
+        self.ids = {}
+        self.values = {}
+
+    def _cache(self, rows):
+        for id_, value in rows:
+            self.ids[value] = id_
+            self.values[id_] = value
+
+    def _select(self, column, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), self.query_size):
+            q = select([self.table.c.id, self.table.c.value]).where(
+                column.in_(keys[i:i + self.query_size])
+            )
+            self._cache(engine.execute(q).fetchall())
+
+    def _insert(self, value):
+        try:
+            result = engine.execute(self.table.insert(), value=value,
+                                    value_hash=value_hash(value))
+            self._cache([(result.inserted_primary_key[0], value)])
+        except IntegrityError:
+            # another process inserted it in the meantime.
+            self._select(self.table.c.value_hash, [value_hash(value)])
+
+    def get_ids(self, values):
+        """Returns a dict from value to id that contains the values in values
+        other than None.  Missing values are inserted."""
+        missing = {value for value in values
+                   if value is not None and value not in self.ids}
+        if missing:
+            self._select(self.table.c.value_hash, map(value_hash, missing))
+            for value in missing:
+                if value not in self.ids:
+                    self._insert(value)
+        return self.ids
+
+    def get_values(self, ids):
+        """Returns a dict from id to value that contains the ids in ids other
+        than None."""
+        missing = {id_ for id_ in ids
+                   if id_ is not None and id_ not in self.values}
+        if missing:
+            self._select(self.table.c.id, missing)
+        return self.values
+
+
+# entry field -> (normalised_entry column, lookup)
+lookups = {
+    'fieldName': ('fieldName_id', Lookup(FieldName)),
+    'dimensions': ('dimensions_id', Lookup(DimensionSet)),
+    'unitIdXbrl': ('unitIdXbrl_id', Lookup(Unit)),
+}
+
+
+def normalise_rows(entries):
+    """Returns the rows of normalised_entry for entries, dicts of
+    financial_statement_entry column values.  Must not be called inside a
+    transaction, since new lookup rows are committed right away."""
+    columns = [(field, id_column,
+                lookup.get_ids([entry.get(field) for entry in entries]))
+               for field, (id_column, lookup) in lookups.items()]
+    rows = []
+    for entry in entries:
+        row = dict(entry)
+        for field, id_column, ids in columns:
+            value = row.pop(field, None)
+            row[id_column] = None if value is None else ids[value]
+        rows.append(row)
+    return rows
+
+
+def entry_columns(fields):
+    """Returns the columns of entry_table() to select for the entry fields
+    in fields.  See entry_values."""
+    table = entry_table()
+    if not is_normalised():
+        return [table.c[field] for field in fields]
+    return [table.c[lookups[field][0]] if field in lookups
+            else table.c[field] for field in fields]
+
+
+def entry_values(rows, fields):
+    """Returns the values of the entry fields in fields for rows selected
+    with entry_columns(fields), as a list of tuples."""
+    if not is_normalised():
+        return [tuple(row) for row in rows]
+    positions = [(i, lookups[field][1]) for i, field in enumerate(fields)
+                 if field in lookups]
+    value_maps = [(i, lookup.get_values([row[i] for row in rows]))
+                  for i, lookup in positions]
+    result = []
+    for row in rows:
+        values = list(row)
+        for i, value_map in value_maps:
+            if values[i] is not None:
+                values[i] = value_map[values[i]]
+        result.append(tuple(values))
+    return result
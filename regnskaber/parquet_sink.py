@@ -0,0 +1,160 @@
+""" Writes feature table rows to Parquet files instead of the database.
+
+The rows of a table are joined with their Header row and partitioned by the
+year of balancedato into
+
+    <directory>/<tablename>/balancedato_year=<year>/part-<part>.parquet
+
+where part is the first financial_statement_id of the range that produced
+the file, so the worker processes of transform --workers never write the
+same file; each worker gets a single range, see
+make_feature_table.populate_tables.  The rows of each partition are kept as
+Arrow record batches until there are row_group_size of them, and then
+written as one row group, so memory use does not depend on the size of the
+table.  Files are written under a temporary name and renamed when complete.
+
+Requires pyarrow, e.g. pip install regnskaber[parquet].
+"""
+import os
+import shutil
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, select
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import engine
+
+unknown_year = '__HIVE_DEFAULT_PARTITION__'
+
+
+def check_pyarrow():
+    if pyarrow is None:
+        raise ImportError('Parquet output requires pyarrow. Install it with '
+                          'pip install pyarrow.')
+
+
+def arrow_type(sql_type):
+    """Returns the arrow type and a python converter for a column type."""
+    if isinstance(sql_type, Boolean):
+        return pyarrow.bool_(), bool
+    if isinstance(sql_type, Integer):
+        return pyarrow.int64(), int
+    if isinstance(sql_type, Float):
+        return pyarrow.float64(), float
+    if isinstance(sql_type, DateTime):
+        return pyarrow.timestamp('us'), None
+    return pyarrow.string(), str
+
+
+def table_directory(directory, tablename):
+    return os.path.join(directory, tablename)
+
+
+def remove_table(directory, tablename):
+    """Removes the files of tablename, the Parquet counterpart of dropping
+    the table."""
+    shutil.rmtree(table_directory(directory, tablename), ignore_errors=True)
+
+
+class ParquetSink(object):
+    """Writes the rows of table, a feature table as returned by
+    make_feature_table.create_table, joined with header_table.  Header
+    columns that a feature column has the same name as are prefixed with
+    header_."""
+
+    def __init__(self, directory, table, header_table, part,
+                 row_group_size=100000):
+        check_pyarrow()
+        self.directory = table_directory(directory, table.name)
+        self.header_table = header_table
+        self.part = part
+        self.row_group_size = row_group_size
+        self.writers = {}
+        # year -> the record batches that are not written yet.
+        self.buffers = {}
+        self.columns = []  # (name, row key, source, converter)
+        fields = []
+        feature_names = {column.name for column in table.columns}
+        for column in header_table.columns:
+            if column.name == 'id':
+                continue
+            name = column.name
+            if name in feature_names:
+                name = 'header_' + name
+            self._add_column(fields, name, column, 'header')
+        for column in table.columns:
+            self._add_column(fields, column.name, column, 'row')
+        self.schema = pyarrow.schema(fields)
+
+    def _add_column(self, fields, name, column, source):
+        type_, converter = arrow_type(column.type)
+        fields.append(pyarrow.field(name, type_))
+        self.columns.append((name, column.name, source, converter))
+
+    def _headers(self, header_ids):
+        q = select([self.header_table]).where(
+            self.header_table.c.id.in_(header_ids)
+        )
+        return {row['id']: dict(row) for row in engine.execute(q)}
+
+    def write(self, rows):
+        headers = self._headers(list({row['headerId'] for row in rows}))
+        partitions = {}
+        for row in rows:
+            header = headers[row['headerId']]
+            balancedato = header['balancedato']
+            year = (unknown_year if balancedato is None
+                    else str(balancedato.year))
+            partitions.setdefault(year, []).append((header, row))
+        for year, pairs in partitions.items():
+            arrays = []
+            for name, key, source, converter in self.columns:
+                values = []
+                for header, row in pairs:
+                    value = (header if source == 'header' else row).get(key)
+                    if value is not None and converter is not None:
+                        value = converter(value)
+                    values.append(value)
+                arrays.append(values)
+            batch = pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(values, type=field.type)
+                 for values, field in zip(arrays, self.schema)],
+                schema=self.schema
+            )
+            buffer = self.buffers.setdefault(year, [])
+            buffer.append(batch)
+            if sum(batch.num_rows for batch in buffer) >= self.row_group_size:
+                self._write_row_group(year)
+        return
+
+    def _write_row_group(self, year):
+        table = pyarrow.Table.from_batches(self.buffers.pop(year),
+                                           schema=self.schema)
+        self._writer(year).write_table(table, row_group_size=table.num_rows)
+
+    def _path(self, year):
+        return os.path.join(self.directory, 'balancedato_year=%s' % year,
+                            'part-%s.parquet' % self.part)
+
+    def _writer(self, year):
+        writer = self.writers.get(year)
+        if writer is None:
+            path = self._path(year)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = pyarrow.parquet.ParquetWriter(path + '.tmp', self.schema)
+            self.writers[year] = writer
+        return writer
+
+    def close(self):
+        for year in list(self.buffers):
+            self._write_row_group(year)
+        for year, writer in self.writers.items():
+            writer.close()
+            path = self._path(year)
+            os.replace(path + '.tmp', path)
+        self.writers = {}
+        return
@@ -1,65 +1,146 @@
 """ This module is responsible for inserting each financial statement 'regnskab'. """
-import datetime
+import sys
+import time
 
 import xbrl_ai
 import xbrl_local.xbrl_ai_dk
 
-from . import Session
+from sqlalchemy import select
+
+from . import Session, engine, normalised, xbrl_stream
 from .models import FinancialStatement, FinancialStatementEntry
 
 
 def initialize_financial_statement(regnskab):
     financial_statement = FinancialStatement(
+        **financial_statement_values(regnskab)
+    )
+    return financial_statement
+
+
+def financial_statement_values(regnskab):
+    return dict(
         offentliggoerelsesTidspunkt=regnskab.offentliggoerelsesTidspunkt,
         indlaesningsTidspunkt=regnskab.indlaesningsTidspunkt,
         cvrnummer=regnskab.cvrnummer,
         erst_id=regnskab.erst_id
     )
-    return financial_statement
 
 
-def insert_regnskab(regnskab):
+def parse_regnskab(regnskab):
+    """Parses the xbrl file of regnskab with the parser chosen by
+    use_parser.
+
+    Returns a list with a dict of column values for each
+    financial_statement_entry, without the financial_statement_id.
+    """
+    return parsers[parser_name](regnskab)
+
+
+def use_parser(name):
+    """Chooses the parser of parse_regnskab, one of the keys of parsers.
+    Processes started afterwards inherit the choice."""
+    global parser_name
+    if name not in parsers:
+        raise ValueError('Unknown parser %r' % (name, ))
+    parser_name = name
+    return
+
+
+def parse_regnskab_xbrl_ai(regnskab):
+    """Parses the xbrl file of regnskab by converting the whole document to
+    a dict with xbrl_ai."""
+    x = xbrl_ai.xbrlinstance_to_dict(regnskab.xbrl_file_contents)
+    y = xbrl_local.xbrl_ai_dk.xbrldict_to_xbrl_dk_64(x)
+    entries = []
+    for key, val in y.items():
+        if key in ('{http://www.xbrl.org/2003/linkbase}schemaRef',
+                   '@{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'):
+            continue
+        fieldName, startDate, endDate = key[0], key[1], key[2]
+        label_typed_id, koncern, xbrl_unit = key[3], key[4], key[5]
+        fieldValue, unit, decimals, dimension_list = val
+
+        if xbrl_unit is not None:
+            xbrl_unit = str(xbrl_unit)
+        if unit is not None:
+            unit = str(unit)
+        if fieldValue is not None:
+            fieldValue = str(fieldValue)
+        if decimals is not None:
+            decimals = str(decimals)
+        assert(xbrl_unit == unit)
+
+        dimensions = label_typed_id
+        # keys in row:
+        # Name,Value,contextRef,unitRef,Dec,Prec,Lang,EntityIdentifier,Start,End/Instant,Dimensions
+        cvrnummer = regnskab.cvrnummer
+
+        entries.append(dict(
+            fieldName=fieldName, fieldValue=fieldValue,
+            decimals=decimals,
+            cvrnummer=cvrnummer,
+            startDate=startDate, endDate=endDate,
+            dimensions=dimensions,
+            unitIdXbrl=xbrl_unit,
+            koncern=koncern
+        ))
+    return entries
+
+
+def parse_regnskab_stream(regnskab):
+    """Parses the xbrl file of regnskab with xbrl_stream, falling back to
+    xbrl_ai for the rare filing whose contexts xbrl_stream cannot label."""
+    try:
+        return xbrl_stream.parse_regnskab(regnskab)
+    except xbrl_stream.UnknownContexts:
+        return parse_regnskab_xbrl_ai(regnskab)
+
+
+parsers = {
+    'xbrl_ai': parse_regnskab_xbrl_ai,
+    'stream': parse_regnskab_stream,
+}
+parser_name = 'xbrl_ai'
+
+
+def delete_financial_statements(connection, erst_ids):
+    """Deletes the financial statements with the given erst_ids and their
+    entries.  connection is a Connection or a Session."""
+    statement_table = FinancialStatement.__table__
+    entry_table = normalised.entry_table()
+    statement_ids = select([statement_table.c.id]).where(
+        statement_table.c.erst_id.in_(erst_ids)
+    )
+    connection.execute(entry_table.delete().where(
+        entry_table.c.financial_statement_id.in_(statement_ids)
+    ))
+    connection.execute(statement_table.delete().where(
+        statement_table.c.erst_id.in_(erst_ids)
+    ))
+    return
+
+
+def insert_regnskab(regnskab, replace=False):
+    """Inserts regnskab.  With replace, a stored financial statement with
+    the same erst_id is deleted first, in the same transaction.  In the
+    normalised schema the entries are written by write_batch."""
+    if normalised.is_normalised():
+        entries = parse_regnskab(regnskab)
+        write_batch([(financial_statement_values(regnskab), entries,
+                      replace)])
+        return
     session = Session()
     try:
-        x = xbrl_ai.xbrlinstance_to_dict(regnskab.xbrl_file_contents)
-        y = xbrl_local.xbrl_ai_dk.xbrldict_to_xbrl_dk_64(x)
+        entries = parse_regnskab(regnskab)
+        if replace:
+            delete_financial_statements(session, [regnskab.erst_id])
         financial_statement = initialize_financial_statement(regnskab)
         session.add(financial_statement)
 
-
-        for key, val in y.items():
-            if key in ('{http://www.xbrl.org/2003/linkbase}schemaRef',
-                       '@{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'):
-                continue
-            fieldName, startDate, endDate = key[0], key[1], key[2]
-            label_typed_id, koncern, xbrl_unit = key[3], key[4], key[5]
-            fieldValue, unit, decimals, dimension_list = val
-
-            if xbrl_unit is not None:
-                xbrl_unit = str(xbrl_unit)
-            if unit is not None:
-                unit = str(unit)
-            if fieldValue is not None:
-                fieldValue = str(fieldValue)
-            if decimals is not None:
-                decimals = str(decimals)
-            assert(xbrl_unit == unit)
-
-            dimensions = label_typed_id
-            # keys in row:
-            # Name,Value,contextRef,unitRef,Dec,Prec,Lang,EntityIdentifier,Start,End/Instant,Dimensions
-            cvrnummer = regnskab.cvrnummer
-
+        for entry_values in entries:
             financial_statement.financial_statement_entries.append(
-                FinancialStatementEntry(
-                    fieldName=fieldName, fieldValue=fieldValue,
-                    decimals=decimals,
-                    cvrnummer=cvrnummer,
-                    startDate=startDate, endDate=endDate,
-                    dimensions=dimensions,
-                    unitIdXbrl=xbrl_unit,
-                    koncern=koncern
-                )
+                FinancialStatementEntry(**entry_values)
             )
 
         session.commit()
@@ -71,5 +152,114 @@ def insert_regnskab(regnskab):
     return
 
 
-def drive_regnskab(regnskab):
-    insert_regnskab(regnskab)
+def write_batch(batch, loader=None):
+    """Inserts a list of (financial statement values, entry values, replace)
+    triples in one transaction using executemany.  Stored financial
+    statements are deleted first for the triples where replace is true.
+
+    If loader is given the entries are instead passed to
+    loader(connection, rows, entry_table), see bulk_load.py.
+    """
+    statement_table = FinancialStatement.__table__
+    entry_table = normalised.entry_table()
+    if normalised.is_normalised():
+        # before the transaction, since new lookup rows are committed at once.
+        batch = [(statement, normalised.normalise_rows(entries), replace)
+                 for statement, entries, replace in batch]
+    with engine.begin() as connection:
+        replaced = [statement['erst_id']
+                    for statement, _, replace in batch if replace]
+        if replaced:
+            delete_financial_statements(connection, replaced)
+        connection.execute(statement_table.insert(),
+                           [statement for statement, _, _ in batch])
+        erst_ids = [statement['erst_id'] for statement, _, _ in batch]
+        ids = dict(connection.execute(
+            select([statement_table.c.erst_id, statement_table.c.id]).where(
+                statement_table.c.erst_id.in_(erst_ids)
+            )
+        ).fetchall())
+        rows = []
+        for statement, entries, _ in batch:
+            financial_statement_id = ids[statement['erst_id']]
+            for entry_values in entries:
+                row = dict(entry_values)
+                row['financial_statement_id'] = financial_statement_id
+                rows.append(row)
+        if rows and loader is not None:
+            loader(connection, rows, entry_table)
+        elif rows:
+            connection.execute(entry_table.insert(), rows)
+    return
+
+
+class BulkInserter(object):
+    """Buffers the parsed entries of many financial statements and inserts
+    them in large batches.
+
+    A batch is written when it holds batch_size entries or when flush_interval
+    seconds have passed since the last write.  The entries are written by
+    loader, or with executemany if loader is None.  If a batch fails, e.g. because
+    another process inserted one of its financial statements, the statements
+    are retried one at a time so a single bad statement only loses itself.
+    """
+
+    def __init__(self, batch_size=10000, flush_interval=30, loader=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.loader = loader
+        self._batch = []
+        self._entry_count = 0
+        self._last_flush = time.monotonic()
+        # the number of calls to flush, so callers can tell when everything
+        # they added has been written.
+        self.flush_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, regnskab, replace=False):
+        self.add_parsed(regnskab, parse_regnskab(regnskab), replace=replace)
+
+    def add_parsed(self, regnskab, entries, replace=False):
+        """Like add, for entries already returned by parse_regnskab."""
+        self._batch.append((financial_statement_values(regnskab), entries,
+                            replace))
+        self._entry_count += len(entries)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        overdue = time.monotonic() - self._last_flush >= self.flush_interval
+        if self._entry_count >= self.batch_size or (self._batch and overdue):
+            self.flush()
+
+    def flush(self):
+        self.flush_count += 1
+        batch = self._batch
+        self._batch = []
+        self._entry_count = 0
+        self._last_flush = time.monotonic()
+        if not batch:
+            return
+        try:
+            write_batch(batch, self.loader)
+        except Exception:
+            for item in batch:
+                try:
+                    write_batch([item], self.loader)
+                except Exception as e:
+                    msg = '[erst_id = %s] Could not insert: %s' % (
+                        item[0]['erst_id'], e
+                    )
+                    print(msg, file=sys.stderr, flush=True)
+        return
+
+
+def drive_regnskab(regnskab, inserter=None, replace=False):
+    if inserter is None:
+        insert_regnskab(regnskab, replace=replace)
+    else:
+        inserter.add(regnskab, replace=replace)
@@ -0,0 +1,159 @@
+""" Inserts financial statements from a local archive of xbrl files.
+
+The archive is a directory, a tar file or a zip file with a manifest.csv that
+has a row per financial statement with the columns erst_id, cvrnummer,
+offentliggoerelsesTidspunkt, indlaesningsTidspunkt and filename, the path of
+the xbrl file inside the archive.  A cache directory made by fetch --cache-dir
+can be used as an archive as well.
+"""
+import csv
+import io
+import os
+import sys
+import tarfile
+import threading
+import zipfile
+
+from multiprocessing import Pool
+
+from . import engine, parse_date
+from .fetch import log_exception, insert_mode, setup_tables, ERASE
+from .regnskab_inserter import drive_regnskab
+from .xbrl_cache import XbrlCache
+
+manifest_name = 'manifest.csv'
+
+
+class ArchivedRegnskab(object):
+    """A financial statement read from an archive.  Has the same attributes
+    as fetch.InputRegnskab."""
+
+    def __init__(self, cvrnummer, offentliggoerelsesTidspunkt,
+                 indlaesningsTidspunkt, erst_id, xbrl_file_bytes):
+        self.cvrnummer = cvrnummer
+        self.offentliggoerelsesTidspunkt = offentliggoerelsesTidspunkt
+        self.indlaesningsTidspunkt = indlaesningsTidspunkt
+        self.erst_id = erst_id
+        self.xbrl_file_bytes = xbrl_file_bytes
+
+    @property
+    def xbrl_file_contents(self):
+        return self.xbrl_file_bytes.decode('utf-8')
+
+
+def read_manifest(fp):
+    """Returns a dict from filename to manifest row."""
+    reader = csv.DictReader(io.TextIOWrapper(fp, encoding='utf-8'))
+    return {row['filename']: row for row in reader}
+
+
+def iter_directory(path):
+    with open(os.path.join(path, manifest_name), 'rb') as fp:
+        manifest = read_manifest(fp)
+    for filename, row in manifest.items():
+        with open(os.path.join(path, filename), 'rb') as fp:
+            yield row, fp.read()
+
+
+def iter_cache(path):
+    cache = XbrlCache(path, offline=True)
+    for msg in cache.messages():
+        cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url = msg[:3]
+        erst_id, indlaesningsTidspunkt = msg[4:]
+        contents = cache.get(xbrl_file_url)
+        if contents is None:
+            continue
+        row = {
+            'erst_id': erst_id,
+            'cvrnummer': cvrnummer,
+            'offentliggoerelsesTidspunkt': offentliggoerelsesTidspunkt,
+            'indlaesningsTidspunkt': indlaesningsTidspunkt,
+            'filename': xbrl_file_url,
+        }
+        yield row, contents
+
+
+def iter_tar(path):
+    with tarfile.open(path) as archive:
+        manifest = read_manifest(archive.extractfile(manifest_name))
+        # members are read in archive order, so compressed archives are
+        # decompressed once.
+        for member in archive:
+            row = manifest.get(member.name)
+            if row is None or not member.isfile():
+                continue
+            yield row, archive.extractfile(member).read()
+
+
+def iter_zip(path):
+    with zipfile.ZipFile(path) as archive:
+        with archive.open(manifest_name) as fp:
+            manifest = read_manifest(fp)
+        for filename, row in manifest.items():
+            yield row, archive.read(filename)
+
+
+def iter_archive(path):
+    """Yields (manifest row, contents of the xbrl file as bytes) for every
+    financial statement in the archive at path."""
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, manifest_name)):
+            return iter_directory(path)
+        return iter_cache(path)
+    if zipfile.is_zipfile(path):
+        return iter_zip(path)
+    return iter_tar(path)
+
+
+def init_worker():
+    engine.dispose()  # for multiprocessing.
+
+
+def reingest_one(row, contents, replace=False):
+    erst_id = row['erst_id']
+    try:
+        cvrnummer = row['cvrnummer']
+        cvrnummer = int(cvrnummer) if cvrnummer else None
+        indlaesningsTidspunkt = parse_date(row['indlaesningsTidspunkt'][:19])
+        regnskab = ArchivedRegnskab(
+            cvrnummer, parse_date(row['offentliggoerelsesTidspunkt'][:19]),
+            indlaesningsTidspunkt, erst_id, contents
+        )
+        mode = insert_mode(erst_id, indlaesningsTidspunkt, incremental=False)
+        if mode is None and not replace:
+            return
+        drive_regnskab(regnskab, replace=(mode is None))
+    except Exception:
+        log_exception(erst_id)
+    return
+
+
+def reingest(path, processes=1, replace=False):
+    """Inserts every financial statement in the archive at path using a pool
+    of processes.  Financial statements that are already stored are skipped,
+    or replaced if replace is true.
+    """
+    setup_tables()
+    engine.dispose()  # for multiprocessing.
+    # bounds the number of files read but not yet inserted.
+    slots = threading.BoundedSemaphore(4 * processes)
+    counts = {'submitted': 0, 'done': 0}
+
+    def done(_):
+        counts['done'] += 1
+        print(ERASE + 'Reingesting: %s/%s' % (counts['done'],
+                                              counts['submitted']),
+              end='', flush=True, file=sys.stderr)
+        slots.release()
+
+    with Pool(processes, initializer=init_worker) as pool:
+        for row, contents in iter_archive(path):
+            slots.acquire()
+            counts['submitted'] += 1
+            pool.apply_async(reingest_one, (row, contents, replace),
+                             callback=done, error_callback=done)
+        pool.close()
+        pool.join()
+    print()
+    print('Reingest Completed')
+    return
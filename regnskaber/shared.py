@@ -3,11 +3,21 @@ import datetime
 from contextlib import closing
 
 from .models import FinancialStatement
-from . import Session
+from .normalised import entry_columns, entry_table, entry_values
+from . import Session, engine
 
+from sqlalchemy import and_, select
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.sql.expression import func
 from collections import namedtuple
 
+entry_fields = ['id', 'financial_statement_id', 'fieldName', 'fieldValue',
+                'decimals', 'cvrnummer', 'startDate', 'endDate', 'dimensions',
+                'unitIdXbrl', 'koncern']
+
+# A financial_statement_entry row, as read by statement_entries_iterator.
+Entry = namedtuple('Entry', entry_fields)
+
 
 def get_reporting_period(fs_entries):
     date_format = '%Y-%m-%d'
@@ -96,38 +106,89 @@ def partition_consolidated(fs_entries):
     return fs_tuples_cons, fs_tuples_solo
 
 
-def get_number_of_rows():
+def get_number_of_rows(start_idx=None, end_idx=None):
     with closing(Session()) as session:
-        total_rows = session.query(FinancialStatement).count()
+        q = session.query(FinancialStatement)
+        if start_idx is not None:
+            q = q.filter(FinancialStatement.id >= start_idx)
+        if end_idx is not None:
+            q = q.filter(FinancialStatement.id < end_idx)
+        total_rows = q.count()
         return total_rows
 
 
-def financial_statement_iterator(end_idx=None, length=None, buffer_size=500, data_transform=None):
+def init_worker():
+    engine.dispose()  # for multiprocessing.
+
+
+def get_max_id():
+    """Returns the largest financial_statement id, or None if there are no
+    financial statements."""
+    with closing(Session()) as session:
+        return session.query(func.max(FinancialStatement.id)).scalar()
+
+
+def id_ranges(range_size=10000, start_idx=None, end_idx=None):
+    """Splits the financial_statement ids with start_idx <= id < end_idx
+    into consecutive ranges.
+
+    Returns a list of (start_idx, end_idx) pairs, each covering range_size
+    financial statements (the last one possibly fewer).  Each range starts
+    at the id range_size ids after the start of the previous one, found
+    with one query on the primary key, so the ids are never all loaded.
+    """
+    table = FinancialStatement.__table__
+    conditions = []
+    if end_idx is not None:
+        conditions.append(table.c.id < end_idx)
+    if start_idx is not None:
+        conditions.append(table.c.id >= start_idx)
+
+    def id_after(first_id, offset):
+        where = conditions + [table.c.id >= first_id]
+        return connection.execute(
+            select([table.c.id]).where(and_(*where)).order_by(
+                table.c.id
+            ).offset(offset).limit(1)
+        ).scalar()
+
+    with engine.connect() as connection:
+        last_id = connection.execute(
+            select([func.max(table.c.id)]).where(and_(*conditions))
+        ).scalar()
+        if last_id is None:
+            return []
+        starts = [id_after(start_idx or 0, 0)]
+        while True:
+            next_id = id_after(starts[-1], range_size)
+            if next_id is None:
+                break
+            starts.append(next_id)
+    ends = starts[1:] + [last_id + 1]
+    return list(zip(starts, ends))
+
+
+def financial_statement_iterator(end_idx=None, length=None, buffer_size=50000,
+                                 data_transform=None, start_idx=1):
     """Provide an iterator over financial_statements in order of id
 
+    Yields (i, total_rows, financial_statement_id, entries) where entries is
+    data_transform applied to the list of Entry tuples of the financial
+    statement, see statement_entries_iterator.
+
     Keyword arguments:
     end_idx -- One past the last financial_statement_id to iterate over.
     length -- The number of financial statements to iterate.
               Note only one of end_idx and length can be provided.
     buffer_size -- the internal buffer size to use for iterating.  The buffer
-                   size is measured in number of financial statements.
+                   size is measured in number of entries.
+    start_idx -- The first financial_statement_id to iterate over.
 
     """
     
     if end_idx is not None and length is not None:
         raise ValueError("Cannot accept both end_idx and length.")
 
-    if end_idx is None and length is None:
-        try:
-            session = Session()
-            max_id = session.query(func.max(FinancialStatement.id)).scalar()
-            end_idx = max_id + 1
-        except (IndexError, ValueError):
-            raise LookupError('Could not lookup maximum financial_statement_id'
-                              ' in financial_statement table.')
-        finally:
-            session.close()
-
     if end_idx is not None:
         assert(isinstance(end_idx, int))
 
@@ -135,20 +196,98 @@ def financial_statement_iterator(end_idx=None, length=None, buffer_size=500, dat
         assert(isinstance(length, int))
         end_idx = length
 
-    total_rows = get_number_of_rows()
+    total_rows = get_number_of_rows(start_idx, end_idx)
     if data_transform is None:
         data_transform = filter_reporting_period
-    with closing(Session()) as session:
-        curr = 1
-        while curr < end_idx:
-            q = session.query(FinancialStatement).filter(
-                FinancialStatement.id >= curr,
-                FinancialStatement.id < min(curr + buffer_size, end_idx)
-            ).enable_eagerloads(True).all()
-            for i, fs in enumerate(q):
-                entries = data_transform(fs.financial_statement_entries)
-                yield i+curr, total_rows, fs.id, entries
-            curr += buffer_size
+    statements = statement_entries_iterator(start_idx, end_idx,
+                                            chunk_size=buffer_size)
+    for i, (fs_id, fs_entries) in enumerate(statements, start=1):
+        yield i, total_rows, fs_id, data_transform(fs_entries)
+    return
+
+
+def check_entry_index():
+    """Prints a warning if the entry table has no index on
+    financial_statement_id, which statement_entries_iterator relies on.
+    create_all does not add it to a table created by an older version."""
+    table = entry_table()
+    indexes = Inspector.from_engine(engine).get_indexes(table.name)
+    if any(index['column_names'][:1] == ['financial_statement_id']
+           for index in indexes):
+        return
+    print('Warning: %s has no index on financial_statement_id, so reading '
+          'the entries is slow. Create it with' % table.name)
+    print('    CREATE INDEX ix_%s_financial_statement_id ON %s '
+          '(financial_statement_id);' % (table.name, table.name))
+
+
+def statement_entries_iterator(start_idx=None, end_idx=None,
+                               chunk_size=50000):
+    """Provide an iterator over the entries of each financial statement in
+    order of financial_statement_id.
+
+    Yields (financial_statement_id, entries) where entries is a list of
+    Entry tuples in order of id.  The entries are read straight from
+    financial_statement_entry in ranges of financial_statement_id that hold
+    whole financial statements, so each query is a range scan of the
+    financial_statement_id index.  A query reads at most chunk_size rows and
+    the financial statement it stops in is read again by the next one, unless
+    it is the only one, in which case it is read by itself.  Financial
+    statements without entries are skipped.
+
+    In the normalised schema (see normalised.py) the values are looked up
+    once per query.
+
+    Keyword arguments:
+    start_idx -- The first financial_statement_id to iterate over.
+    end_idx -- One past the last financial_statement_id to iterate over.
+    """
+    columns = entry_columns(entry_fields)
+    fs_id_col, name_col, id_col = [columns[entry_fields.index(field)]
+                                   for field in ('financial_statement_id',
+                                                 'fieldName', 'id')]
+    conditions = [fs_id_col.isnot(None), name_col.isnot(None)]
+    if end_idx is not None:
+        conditions.append(fs_id_col < end_idx)
+    query = select(columns).order_by(fs_id_col, id_col)
+
+    def statements(rows):
+        current_id = None
+        entries = []
+        for values in entry_values(rows, entry_fields):
+            entry = Entry(*values)
+            if entry.financial_statement_id != current_id:
+                if entries:
+                    yield current_id, entries
+                current_id = entry.financial_statement_id
+                entries = []
+            entries.append(entry)
+        if entries:
+            yield current_id, entries
+
+    next_id = start_idx
+    with engine.connect() as connection:
+        while True:
+            where = list(conditions)
+            if next_id is not None:
+                where.append(fs_id_col >= next_id)
+            rows = connection.execute(
+                query.where(and_(*where)).limit(chunk_size)
+            ).fetchall()
+            if len(rows) < chunk_size:
+                yield from statements(rows)
+                break
+            last_id = rows[-1][fs_id_col]
+            if rows[0][fs_id_col] == last_id:
+                # a single financial statement with more than chunk_size
+                # entries.
+                rows = connection.execute(
+                    query.where(and_(*(conditions + [fs_id_col == last_id])))
+                ).fetchall()
+            else:
+                rows = [row for row in rows if row[fs_id_col] != last_id]
+            yield from statements(rows)
+            next_id = rows[-1][fs_id_col] + 1
     return
 
 
@@ -158,13 +297,9 @@ def tag_previous_reporting_period(fs_entries):
 
     """
     prev_tag = '_prev'
-    tuple_entry = namedtuple('tuple_entry', ['id', 'financial_statement_id', 'fieldName', 'fieldValue', 'decimals', 'cvrnummer', 'startDate', 'endDate', 'dimensions', 'unitIdXbrl', 'koncern'])
 
     def make_prev_tuple(my_entry):
-        dd = my_entry.__dict__
-        dt = {x: dd[x] for x in tuple_entry._fields}
-        dt['fieldName'] = dt['fieldName'] + prev_tag
-        return tuple_entry(**dt)
+        return my_entry._replace(fieldName=my_entry.fieldName + prev_tag)
             
     data_dict = {}
     for elm in fs_entries:
@@ -0,0 +1,97 @@
+""" A local cache of downloaded xbrl files.
+
+Every file is stored gzip compressed under objects/, addressed by the sha256
+of its url.  index.tsv has a line per cached financial statement with the
+metadata fetch needs to insert it again, so the cache alone is enough to
+re-ingest everything without network access.
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+
+index_fields = ['erst_id', 'cvrnummer', 'offentliggoerelsesTidspunkt',
+                'indlaesningsTidspunkt', 'xbrl_file_url', 'xbrl_extension_url']
+
+
+def format_field(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()[:19]
+    return str(value)
+
+
+class XbrlCache(object):
+    """Cache of xbrl files in directory.
+
+    With offline, files missing from the cache are not downloaded.
+    """
+
+    def __init__(self, directory, offline=False):
+        self.directory = directory
+        self.offline = offline
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.tsv')
+
+    def _object_path(self, xbrl_file_url):
+        key = hashlib.sha256(xbrl_file_url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'objects', key[:2], key + '.gz')
+
+    def get(self, xbrl_file_url):
+        """Returns the cached contents of xbrl_file_url as bytes, or None."""
+        try:
+            with gzip.open(self._object_path(xbrl_file_url), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, regnskab, contents):
+        """Stores contents, the bytes of the xbrl file of regnskab, and adds
+        regnskab to the index."""
+        path = self._object_path(regnskab.xbrl_file_url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first so readers never see a partial
+        # file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as raw, \
+                    gzip.GzipFile(fileobj=raw, mode='wb') as fp:
+                fp.write(contents)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        line = '\t'.join(format_field(getattr(regnskab, field))
+                         for field in index_fields)
+        with open(self.index_path, 'a') as fp:
+            fp.write(line + '\n')
+        return
+
+    def messages(self):
+        """Yields a queue message (see fetch.producer_scan) for every
+        financial statement in the index."""
+        seen = set()
+        try:
+            fp = open(self.index_path)
+        except FileNotFoundError:
+            return
+        with fp:
+            for line in fp:
+                values = line.rstrip('\n').split('\t')
+                if len(values) != len(index_fields):
+                    continue  # incomplete line from an interrupted write.
+                values = dict(zip(index_fields, values))
+                erst_id = values['erst_id']
+                if erst_id in seen:
+                    continue
+                seen.add(erst_id)
+                cvrnummer = values['cvrnummer']
+                cvrnummer = int(cvrnummer) if cvrnummer else None
+                yield (cvrnummer, values['offentliggoerelsesTidspunkt'],
+                       values['xbrl_file_url'],
+                       values['xbrl_extension_url'] or None, erst_id,
+                       values['indlaesningsTidspunkt'])
@@ -0,0 +1,238 @@
+""" A streaming parser for xbrl instance files.
+
+The instance is read with lxml.etree.iterparse and every element is discarded
+as soon as it has been handled, so only the contexts, the units and the facts
+found so far are kept in memory, never the whole document tree.  The facts
+are returned as entry dicts like those of regnskab_inserter.parse_regnskab.
+
+The entries are not the same as the xbrl_ai parser's: fieldValue is the text
+of the fact as it is, fieldName uses the prefixes of the document, and of
+several facts with the same key the first is kept.
+
+The dimensions and koncern of each context are computed by xbrl_ai itself, so
+they are stored exactly as by the xbrl_ai parser: the contexts are put in a
+small instance with one probe fact each, which xbrl_ai converts like a whole
+filing (see context_labels).
+"""
+import io
+import re
+
+import xbrl_ai
+import xbrl_local.xbrl_ai_dk
+
+from lxml import etree
+
+XBRLI = '{http://www.xbrl.org/2003/instance}'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+XSI_NIL = '{http://www.w3.org/2001/XMLSchema-instance}nil'
+
+probe_namespace = 'http://regnskaber/xbrl_stream/probe'
+probe_name = re.compile(r'ContextProbe(\d+)$')
+
+
+class UnknownContexts(Exception):
+    """Raised when xbrl_ai does not label every context of a filing, see
+    context_labels."""
+
+
+def prefixed_name(element):
+    """Returns the name of element as prefix:localname."""
+    qname = etree.QName(element)
+    if element.prefix is None:
+        return qname.localname
+    return '%s:%s' % (element.prefix, qname.localname)
+
+
+def text(element):
+    return ''.join(element.itertext()).strip()
+
+
+def language(element):
+    """Returns the xml:lang of element, inherited from its ancestors."""
+    while element is not None:
+        lang = element.get(XML_LANG)
+        if lang is not None:
+            return lang
+        element = element.getparent()
+    return None
+
+
+def parse_period(element):
+    """Returns (startDate, endDate) of a xbrli:context.  An instant has
+    startDate None."""
+    start_date = end_date = None
+    instant = element.find('.//%sinstant' % XBRLI)
+    if instant is not None:
+        end_date = text(instant)
+    else:
+        start = element.find('.//%sstartDate' % XBRLI)
+        end = element.find('.//%sendDate' % XBRLI)
+        if start is not None:
+            start_date = text(start)
+        if end is not None:
+            end_date = text(end)
+    return start_date, end_date
+
+
+def context_labels(contexts, nsmap):
+    """Returns a dict from context id to (dimensions, koncern) as xbrl_ai
+    computes them.
+
+    contexts is a dict from context id to the serialised xbrli:context, and
+    nsmap the namespaces of the filing.  Raises UnknownContexts if xbrl_ai
+    does not return a fact for every context.
+    """
+    nsmap = dict(nsmap)
+    nsmap['regnskaberprobe'] = probe_namespace
+    root = etree.Element('%sxbrl' % XBRLI, nsmap=nsmap)
+    context_ids = list(contexts)
+    for context in contexts.values():
+        root.append(etree.fromstring(context))
+    for i, context_id in enumerate(context_ids):
+        fact = etree.SubElement(root, '{%s}ContextProbe%d'
+                                % (probe_namespace, i))
+        fact.set('contextRef', context_id)
+        fact.text = 'probe'
+    x = xbrl_ai.xbrlinstance_to_dict(etree.tostring(root, encoding='unicode'))
+    y = xbrl_local.xbrl_ai_dk.xbrldict_to_xbrl_dk_64(x)
+    labels = {}
+    for key in y:
+        if not isinstance(key, tuple):
+            continue
+        match = probe_name.search(str(key[0]))
+        if match:
+            labels[context_ids[int(match.group(1))]] = (key[3], key[4])
+    if len(labels) < len(context_ids):
+        raise UnknownContexts('%s of %s contexts'
+                              % (len(context_ids) - len(labels),
+                                 len(context_ids)))
+    return labels
+
+
+def parse_unit(element):
+    """Returns the measure of a xbrli:unit, numerator/denominator for a
+    divide."""
+    def measures(parent):
+        return '*'.join(map(text, parent.iter('%smeasure' % XBRLI)))
+
+    divide = element.find('%sdivide' % XBRLI)
+    if divide is None:
+        return measures(element)
+    return '%s/%s' % (measures(divide.find('%sunitNumerator' % XBRLI)),
+                      measures(divide.find('%sunitDenominator' % XBRLI)))
+
+
+class FactCollector(object):
+    """Turns facts into entry dicts once the contexts and units are known.
+    Facts are kept by (fieldName, period, dimensions, koncern, unit) and the
+    first fact with a given key wins.
+
+    contexts maps a context id to (startDate, endDate, dimensions, koncern)
+    and units a unit id to its measure.
+    """
+
+    def __init__(self, cvrnummer):
+        self.cvrnummer = cvrnummer
+        self.contexts = {}
+        self.units = {}
+        self.entries = {}
+        self.facts = []
+
+    def add_fact(self, fact):
+        self.facts.append(fact)
+
+    def _resolve(self, fact):
+        fieldName, value, context_ref, unit_ref, decimals, lang = fact
+        context = self.contexts.get(context_ref)
+        if context is None:
+            return False
+        if unit_ref is not None:
+            unit = self.units.get(unit_ref)
+            if unit is None:
+                return False
+        elif lang is not None:
+            unit = 'lang:%s' % lang
+        else:
+            unit = None
+        start_date, end_date, dimensions, koncern = context
+        key = (fieldName, start_date, end_date, dimensions, koncern, unit)
+        if key not in self.entries:
+            self.entries[key] = dict(
+                fieldName=fieldName, fieldValue=value,
+                decimals=decimals,
+                cvrnummer=self.cvrnummer,
+                startDate=start_date, endDate=end_date,
+                dimensions=dimensions,
+                unitIdXbrl=unit,
+                koncern=koncern
+            )
+        return True
+
+    def finish(self):
+        for fact in self.facts:
+            self._resolve(fact)
+        self.facts = []
+        return list(self.entries.values())
+
+
+def iter_elements(source, encoding=None):
+    """Yields every element below the root of the xbrl instance in source, a
+    file object, once it has been parsed.  Children of the root are cleared
+    when the caller is done with them."""
+    events = etree.iterparse(source, events=('start', 'end'),
+                             encoding=encoding, huge_tree=True,
+                             remove_comments=True, remove_pis=True)
+    root = None
+    depth = 0
+    for event, element in events:
+        if event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            continue  # the root.
+        yield element
+        if depth == 1:
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+
+
+def parse_regnskab(regnskab):
+    """Parses the xbrl file of regnskab like regnskab_inserter.parse_regnskab,
+    without building the whole document in memory.  The raw bytes go
+    straight to the parser, which decodes them as the xml declaration says."""
+    source = io.BytesIO(regnskab.xbrl_file_bytes)
+    return parse_xbrl(source, regnskab.cvrnummer)
+
+
+def parse_xbrl(source, cvrnummer, encoding=None):
+    """Returns the entry dicts of the xbrl instance in source, a file
+    object.  Raises UnknownContexts if xbrl_ai cannot label the contexts."""
+    collector = FactCollector(cvrnummer)
+    periods = {}
+    contexts = {}
+    nsmap = None
+    for element in iter_elements(source, encoding=encoding):
+        if nsmap is None:
+            nsmap = element.getparent().nsmap
+        if element.tag == '%scontext' % XBRLI:
+            periods[element.get('id')] = parse_period(element)
+            contexts[element.get('id')] = etree.tostring(element)
+        elif element.tag == '%sunit' % XBRLI:
+            collector.units[element.get('id')] = parse_unit(element)
+        elif element.get('contextRef') is not None:
+            value = None if element.get(XSI_NIL) == 'true' else text(element)
+            collector.add_fact((
+                prefixed_name(element), value, element.get('contextRef'),
+                element.get('unitRef'), element.get('decimals'),
+                language(element)
+            ))
+    if contexts:
+        labels = context_labels(contexts, nsmap)
+        for context_id, (start_date, end_date) in periods.items():
+            collector.contexts[context_id] = ((start_date, end_date) +
+                                              labels[context_id])
+    return collector.finish()
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import time
+import unittest
+
+from multiprocessing import Event, Process, Queue
+from queue import Empty
+
+from regnskaber.ioqueue import IOQueue
+
+
+class StallingQueue(IOQueue):
+    """An IOQueue whose consumer stalls right after it claims its first
+    position while stall is set, and then sets claimed."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stall = Event()
+        self.claimed = Event()
+
+    def _claim(self, counter):
+        position = super()._claim(counter)
+        if counter is self._head and self.stall.is_set():
+            self.stall.clear()
+            self.claimed.set()
+            time.sleep(0.5)
+        return position
+
+
+def produce(queue, count, consumers):
+    for i in range(count):
+        queue.put(('message', i))
+    for _ in range(consumers):
+        queue.put('DONE')
+    queue.flush()
+
+
+def consume(queue, results, stall):
+    if stall:
+        queue.stall.set()
+    else:
+        queue.claimed.wait()
+    received = []
+    while True:
+        message = queue.get()
+        if message == 'DONE':
+            break
+        received.append(message[1])
+    results.put((stall, received))
+
+
+class IOQueueTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_put_get(self):
+        queue = IOQueue(self.filename, capacity=4)
+        messages = [('a', 1, None), 'b', ('c' * 2000, 2)]
+        for message in messages:
+            queue.put(message)
+        queue.flush()
+        self.assertEqual([queue.get() for _ in messages], messages)
+
+    def test_stalled_consumer(self):
+        """A consumer that stalls after claiming a position gets the message
+        of that position, and the other consumers go on with the later
+        ones, several laps around the ring, in order."""
+        count = 200
+        queue = StallingQueue(self.filename, capacity=4)
+        results = Queue()
+        consumers = [Process(target=consume, args=(queue, results, stall))
+                     for stall in (True, False, False)]
+        for process in consumers:
+            process.start()
+        producer = Process(target=produce,
+                           args=(queue, count, len(consumers)))
+        producer.start()
+        try:
+            received = [results.get(timeout=30) for _ in consumers]
+        except Empty:
+            self.fail('a message was lost')
+        finally:
+            for process in consumers + [producer]:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+
+        everything = []
+        for stall, messages in received:
+            self.assertEqual(messages, sorted(messages))
+            everything.extend(messages)
+        self.assertEqual(sorted(everything), list(range(count)))
+        stalled = [messages for stall, messages in received if stall][0]
+        self.assertEqual(stalled[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()